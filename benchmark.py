@@ -0,0 +1,192 @@
+"""
+    Нагрузочный тест сетевого слоя на локальной fakepanel.
+
+    Для каждого размера инбаунда измеряет ops/s и задержки p50/p99:
+    get_client_config из кэша и без него, upsert_client и заполнение
+    нового сервера (reconcile_server). База данных не нужна.
+
+    Запуск: python benchmark.py --sizes 1000 10000 100000 --latency 0.01
+"""
+
+import time
+import random
+import asyncio
+import logging
+import argparse
+
+from datetime import datetime, timedelta
+
+import config
+import network
+import registry
+
+from database import User
+from fakepanel import FakePanel, start
+from logger import logger
+from panel import Panel, client_settings
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def measure(name, size, ops, concurrency, operation):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(i):
+        async with semaphore:
+            started = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[run(i) for i in range(ops)])
+    elapsed = time.perf_counter() - started
+
+    report(name, size, len(latencies), len(latencies) / elapsed, latencies)
+
+
+def report(name, size, ops, rate, latencies):
+    print(
+        f"{name:<24} {size:>8} {ops:>8} {rate:>10.1f} "
+        f"{percentile(latencies, 0.5) * 1000:>10.2f} {percentile(latencies, 0.99) * 1000:>10.2f}"
+    )
+
+
+async def connect(address, server_id):
+    server_info = {
+        "id": server_id,
+        "full_address": address,
+        "panel": "sanaei",
+        "username": "admin",
+        "password": "admin",
+    }
+
+    xui = Panel(full_address=address, panel="sanaei")
+    await xui.login("admin", "admin")
+
+    return xui, server_info
+
+
+async def bench_size(size, args):
+    fake = FakePanel(
+        clients=size,
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+    )
+    runner, address = await start(fake)
+    xui, server_info = await connect(address, "bench")
+
+    registry.REGISTRY = registry.ServerRegistry(
+        [registry.ServerState(xui, True, server_info)]
+    )
+
+    # Тяжелые операции читают весь инбаунд, поэтому на больших размерах их меньше
+    heavy_ops = max(10, args.ops * 1000 // size)
+
+    def email(i):
+        return str(1000000 + random.randrange(size))
+
+    try:
+        await measure(
+            "get_client_config",
+            size,
+            args.ops,
+            args.concurrency,
+            lambda i: network.get_client_config(xui, 2, email(i), server_info),
+        )
+
+        async def cold(i):
+            xui.invalidate(2)
+            await network.get_client_config(xui, 2, email(i), server_info)
+
+        await measure("get_client_config cold", size, heavy_ops, 1, cold)
+
+        expire_time = datetime.utcnow() + timedelta(days=30)
+
+        await measure(
+            "upsert_client",
+            size,
+            heavy_ops,
+            args.concurrency,
+            lambda i: network.upsert_client(
+                expire_time, User(id=int(email(i)), uuid=f"bench-{i}"), True
+            ),
+        )
+    finally:
+        await xui.close()
+        await runner.cleanup()
+
+    # Новый сервер: пустая панель и size клиентов из базы
+    fake = FakePanel(clients=0, latency=args.latency, jitter=args.jitter)
+    runner, address = await start(fake)
+    xui, server_info = await connect(address, "backfill")
+
+    desired = {
+        str(1000000 + i): client_settings(
+            email=str(1000000 + i),
+            uuid=f"00000000-0000-4000-8000-{i:012d}",
+            enable=True,
+            flow="xtls-rprx-vision",
+            limit_ip=5,
+            expire_time=int(expire_time.timestamp() * 1000),
+        )
+        for i in range(size)
+    }
+
+    batches = []
+    add_clients = xui.add_clients
+
+    async def timed_add_clients(inbound_id, clients):
+        started = time.perf_counter()
+        try:
+            return await add_clients(inbound_id, clients)
+        finally:
+            batches.append(time.perf_counter() - started)
+
+    xui.add_clients = timed_add_clients
+
+    try:
+        result = await network.reconcile_server(xui, server_info, desired=desired)
+        report("backfill (per batch)", size, result["added"], result["throughput"], batches)
+
+        if result["failed"] or len(fake.clients) != size:
+            print(f"backfill incomplete: {result}")
+    finally:
+        await xui.close()
+        await runner.cleanup()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="network layer benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--ops", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=float("inf"),
+        help="XUI_RECONCILE_RATE for backfill, unlimited by default",
+    )
+    args = parser.parse_args()
+
+    config.XUI_RECONCILE_RATE = args.rate
+    logger.setLevel(logging.WARNING)
+
+    print(
+        f"{'operation':<24} {'clients':>8} {'ops':>8} {'ops/s':>10} "
+        f"{'p50 ms':>10} {'p99 ms':>10}"
+    )
+
+    for size in args.sizes:
+        await bench_size(size, args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
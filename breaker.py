@@ -0,0 +1,76 @@
+import time
+
+import config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    def __str__(self):
+        return "circuit is open"
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для запросов к одной панели.
+
+    Открывается после failures ошибок подряд (медленный ответ дольше latency
+    секунд тоже считается ошибкой). Пока открыт, вызовы сразу отклоняются;
+    через reset_timeout пропускает half_open_calls пробных запросов и по их
+    результату закрывается или открывается снова.
+    """
+
+    def __init__(
+        self,
+        failures: int = None,
+        latency: float = None,
+        reset_timeout: float = None,
+        half_open_calls: int = 1,
+    ):
+        self.failures = failures or config.XUI_BREAKER_FAILURES
+        self.latency = latency or config.XUI_BREAKER_LATENCY
+        self.reset_timeout = reset_timeout or config.XUI_BREAKER_RESET
+        self.half_open_calls = half_open_calls
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+
+            self.state = HALF_OPEN
+            self.probes = 0
+
+        # HALF_OPEN: пропускаем ограниченное число пробных запросов
+        if self.probes >= self.half_open_calls:
+            return False
+
+        self.probes += 1
+        return True
+
+    def record(self, ok: bool, elapsed: float = 0.0) -> None:
+        if ok and elapsed <= self.latency:
+            self.consecutive_failures = 0
+            self.state = CLOSED
+            return
+
+        self.consecutive_failures += 1
+
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failures:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == OPEN and (
+            time.monotonic() - self.opened_at < self.reset_timeout
+        )
@@ -9,6 +9,65 @@ TELEGRAM_CHANNEL = "@blazesecurity"
 
 # database
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 10000))
+# Компрессор без установленного модуля pymongo пропускает с предупреждением
+MONGODB_COMPRESSORS = os.getenv("MONGODB_COMPRESSORS", "zstd,zlib")
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 10000)
+)
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", 10000))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", 0)) or None
+MONGODB_READ_PREFERENCE = os.getenv("MONGODB_READ_PREFERENCE", "primary")
+# Чтение по группам запросов (stats, history), например
+# "stats=secondaryPreferred,history=secondaryPreferred"; остальное читает primary
+MONGODB_READ_PREFERENCES = dict(
+    item.split("=", 1)
+    for item in os.getenv("MONGODB_READ_PREFERENCES", "").split(",")
+    if item
+)
+MONGODB_EXPLAIN = os.getenv("MONGODB_EXPLAIN", "0") == "1"
+MONGODB_TRANSACTIONS = os.getenv("MONGODB_TRANSACTIONS", "0") == "1"  # нужен replica set
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", 1000))
+STATS_TTL = float(os.getenv("STATS_TTL", 30))
+SUB_CACHE_TTL = int(os.getenv("SUB_CACHE_TTL", 300))
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", 100000))
+BAN_POLL_INTERVAL = float(os.getenv("BAN_POLL_INTERVAL", 30))
+PRICING_POLL_INTERVAL = float(os.getenv("PRICING_POLL_INTERVAL", 60))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+
+# 3x-ui panels
+XUI_REQUEST_TIMEOUT = int(os.getenv("XUI_REQUEST_TIMEOUT", 15))
+XUI_CONNECT_TIMEOUT = int(os.getenv("XUI_CONNECT_TIMEOUT", 5))
+XUI_CONNECTIONS_LIMIT = int(os.getenv("XUI_CONNECTIONS_LIMIT", 20))
+XUI_KEEPALIVE_TIMEOUT = int(os.getenv("XUI_KEEPALIVE_TIMEOUT", 60))
+XUI_SERVER_CONCURRENCY = int(os.getenv("XUI_SERVER_CONCURRENCY", 4))
+XUI_FANOUT_DEADLINE = float(os.getenv("XUI_FANOUT_DEADLINE", 10))
+XUI_SNAPSHOT_TTL = int(os.getenv("XUI_SNAPSHOT_TTL", 60))
+XUI_LINK_DEADLINE = float(os.getenv("XUI_LINK_DEADLINE", 3))
+XUI_BREAKER_FAILURES = int(os.getenv("XUI_BREAKER_FAILURES", 3))
+XUI_BREAKER_LATENCY = float(os.getenv("XUI_BREAKER_LATENCY", 5))
+XUI_BREAKER_RESET = float(os.getenv("XUI_BREAKER_RESET", 30))
+XUI_RECONCILE_BATCH = int(os.getenv("XUI_RECONCILE_BATCH", 100))
+XUI_RECONCILE_RATE = float(os.getenv("XUI_RECONCILE_RATE", 50))
+XUI_RECONCILE_CONCURRENCY = int(os.getenv("XUI_RECONCILE_CONCURRENCY", 2))
+XUI_DRIFT_CRON = os.getenv("XUI_DRIFT_CRON", "30 * * * *")
+
+# outbox of panel mutations
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", 2))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", 600))
+OUTBOX_STALE_TIMEOUT = int(os.getenv("OUTBOX_STALE_TIMEOUT", 300))
+
+# traffic sampler
+TRAFFIC_SAMPLE_CRON = os.getenv("TRAFFIC_SAMPLE_CRON", "* * * * *")
+TRAFFIC_SAMPLES = int(os.getenv("TRAFFIC_SAMPLES", 1440))
+TRAFFIC_TIMESERIES = os.getenv("TRAFFIC_TIMESERIES", "0") == "1"
+TRAFFIC_TIMESERIES_TTL = int(os.getenv("TRAFFIC_TIMESERIES_TTL", 30 * 24 * 3600))
 
 # merchant
 MERCHANT_API_URL = "https://api.cryptomus.com/v1"
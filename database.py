@@ -1,19 +1,62 @@
 ﻿from motor import motor_asyncio
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from dateutil.relativedelta import relativedelta
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Tuple
 from datetime import datetime, timedelta, timezone
 from bson import ObjectId
+from collections import OrderedDict
 
 import uuid
+import time
+import asyncio
 
 from logger import logger
 
 import config
 
-db_client = motor_asyncio.AsyncIOMotorClient(config.MONGODB_URI)
+db_client = motor_asyncio.AsyncIOMotorClient(
+    config.MONGODB_URI,
+    appname="blazevpn",
+    maxPoolSize=config.MONGODB_MAX_POOL_SIZE,
+    minPoolSize=config.MONGODB_MIN_POOL_SIZE,
+    waitQueueTimeoutMS=config.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+    compressors=config.MONGODB_COMPRESSORS,
+    serverSelectionTimeoutMS=config.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=config.MONGODB_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=config.MONGODB_SOCKET_TIMEOUT_MS,
+    readPreference=config.MONGODB_READ_PREFERENCE,
+)
 db = db_client["blazevpn"]
 
+# Ошибка в имени режима должна остановить запуск, а не первый запрос
+READ_PREFERENCES = {}
+
+for route, mode in config.MONGODB_READ_PREFERENCES.items():
+    try:
+        READ_PREFERENCES[route] = make_read_preference(read_pref_mode_from_name(mode), None)
+    except ValueError:
+        raise ValueError(f"unknown read preference {mode!r} for {route!r} reads")
+
+
+def reader(route: str):
+    """
+    База для чтений группы route с read preference из MONGODB_READ_PREFERENCES.
+
+    stats — счетчики, history — история подписок и массовые выборки.
+    Эти чтения терпят отставание реплики. Записи, балансы, активные подписки
+    и то, что перечитывается по change stream или записывается обратно
+    (серверы, тарифы, баны), всегда идут через db.
+    """
+    read_preference = READ_PREFERENCES.get(route)
+
+    if read_preference is None:
+        return db
+
+    return db.with_options(read_preference=read_preference)
+
 
 class PyObjectId(ObjectId):
     @classmethod
@@ -31,7 +74,71 @@ class PyObjectId(ObjectId):
         schema.update(type="string", format="uuid")
 
 
+def projection(model) -> dict:
+    # Только поля модели, остальное содержимое документа по сети не передается
+    fields = {field.alias or name: 1 for name, field in model.model_fields.items()}
+    fields.setdefault("_id", 0)
+    return fields
+
+
+def load(model, doc: dict, lean: bool):
+    # Документы из базы проверены при записи, в lean-режиме модель не строится
+    return RECORDS[model](doc) if lean else model(**doc)
+
+
+class LRUCache:
+    """
+    Ограниченный кэш с вытеснением давно не используемых записей и TTL.
+
+    Считает попадания и промахи; get возвращает None и для отсутствующих,
+    и для устаревших записей.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.items.get(key)
+
+        if item is None or item[1] <= time.monotonic():
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return None
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value) -> None:
+        self.items[key] = (value, time.monotonic() + self.ttl)
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key) -> None:
+        self.items.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
 class WalletService:
+    # upsert_many опирается на уникальность: параллельные пополнения
+    # не должны создать второй кошелек в той же валюте
+    INDEXES = [("wallets", [("order_id", 1), ("currency", 1)], {"unique": True})]
+
     @staticmethod
     async def get_all_by_user(id: int):
         wallets = await db.wallets.find({"order_id": str(id)}).to_list(None)
@@ -39,29 +146,45 @@ class WalletService:
 
     @staticmethod
     async def upsert(wallet: dict):
+        # У пользователя по кошельку на валюту, order_id у них общий
         result = await db.wallets.update_one(
-            {"order_id": wallet["order_id"]}, {"$set": wallet}, upsert=True
+            {"order_id": wallet["order_id"], "currency": wallet["currency"]},
+            {"$set": wallet},
+            upsert=True,
         )
         if result:
             return result
 
     @staticmethod
-    async def upsert_many(wallets: List[dict]):
-        results = []
-        for wallet in wallets:
-            existing_wallet = await db.wallets.find_one(
-                {"order_id": wallet["order_id"], "currency": wallet["currency"]}
+    async def upsert_many(wallets: List[dict]) -> List[dict]:
+        # Пустые ответы мерчанта пропускаем
+        wallets = [
+            wallet for wallet in wallets if wallet.get("order_id") and wallet.get("currency")
+        ]
+
+        if not wallets:
+            return []
+
+        # Один bulk_write вместо find_one и update/insert на каждый кошелек
+        requests = [
+            UpdateOne(
+                {"order_id": wallet["order_id"], "currency": wallet["currency"]},
+                {"$set": wallet},
+                upsert=True,
             )
-            if existing_wallet:
-                # Если кошелек уже существует, обновляем его данные
-                result = await db.wallets.update_one(
-                    {"_id": existing_wallet["_id"]}, {"$set": wallet}
-                )
-            else:
-                # Если кошелка нет, добавляем его
-                result = await db.wallets.insert_one(wallet)
-            results.append(result)
-        return results
+            for wallet in wallets
+        ]
+
+        try:
+            result = await db.wallets.bulk_write(requests, ordered=False)
+        except BulkWriteError:
+            # Параллельный вызов вставил те же кошельки — теперь это обновления
+            result = await db.wallets.bulk_write(requests, ordered=False)
+
+        for index, _id in result.upserted_ids.items():
+            wallets[index]["_id"] = _id
+
+        return wallets
 
 
 class User(BaseModel):
@@ -74,20 +197,17 @@ class User(BaseModel):
     total_spent: float = 0.00
 
     async def get_active_sub(self) -> Optional["Subscription"]:
-        subscriptions = await db.subscriptions.find({"user_id": self.id}).to_list(None)
-        for sub_data in subscriptions:
-            sub = Subscription(**sub_data)
-            if sub.active:
-                return sub
-        return None
+        return await SubService.get_active(self.id)
 
-    async def get_all_subs(self) -> List["Subscription"]:
+    async def get_all_subs(self, lean: bool = False) -> List["Subscription"]:
         subscriptions = (
-            await db.subscriptions.find({"user_id": self.id})
+            await reader("history").subscriptions.find(
+                {"user_id": self.id}, projection(Subscription) if lean else None
+            )
             .sort("datetime_end", -1)
             .to_list(None)
         )
-        return [Subscription(**sub) for sub in subscriptions]
+        return [load(Subscription, sub, lean) for sub in subscriptions]
 
     async def get_wallets(self) -> List[dict]:
         return await WalletService.get_all_by_user(self.id)
@@ -97,14 +217,14 @@ class User(BaseModel):
         return await WalletService.upsert(wallet)
 
     async def get_referral_count(self) -> int:
-        return await db.users.count_documents({"referral_id": self.id})
+        return await reader("stats").users.count_documents({"referral_id": self.id})
 
     async def add_subscription(self, sub: "Subscription") -> "Subscription":
         sub.user_id = self.id
         return await SubService.upsert(sub)
 
     async def remove_subscription(self, sub: "Subscription") -> None:
-        await db.subscriptions.delete_one({"_id": sub.id})
+        await SubService.remove(sub)
 
     @property
     async def is_admin(self) -> bool:
@@ -127,8 +247,7 @@ class Subscription(BaseModel):
         datetime_end += date_to
 
     async def get_user(self) -> Optional[User]:
-        user_data = await db.users.find_one({"id": self.user_id})
-        return User(**user_data) if user_data else None
+        return await UserService.get(self.user_id)
 
     class Config:
         arbitrary_types_allowed = True
@@ -136,7 +255,56 @@ class Subscription(BaseModel):
         populate_by_name = True
 
 
+class UserRecord:
+    """Запись пользователя только для чтения, без валидации pydantic."""
+
+    __slots__ = (
+        "id",
+        "register_time",
+        "balance",
+        "uuid",
+        "referral_id",
+        "referral_days",
+        "total_spent",
+    )
+
+    def __init__(self, doc: dict):
+        self.id = doc["id"]
+        self.register_time = doc.get("register_time")
+        self.balance = doc.get("balance", 0.0)
+        self.uuid = doc.get("uuid")
+        self.referral_id = doc.get("referral_id", 0)
+        self.referral_days = doc.get("referral_days", 0)
+        self.total_spent = doc.get("total_spent", 0.0)
+
+
+class SubscriptionRecord:
+    """Запись подписки только для чтения, без валидации pydantic."""
+
+    __slots__ = ("id", "user_id", "datetime_start", "datetime_end", "plan", "cost")
+
+    def __init__(self, doc: dict):
+        self.id = doc["_id"]
+        self.user_id = doc["user_id"]
+        self.datetime_start = doc["datetime_start"]
+        self.datetime_end = doc["datetime_end"]
+        self.plan = doc.get("plan")
+        self.cost = doc.get("cost")
+
+    @property
+    def active(self) -> bool:
+        return self.datetime_end > datetime.utcnow()
+
+    async def get_user(self) -> Optional[User]:
+        return await UserService.get(self.user_id)
+
+
+RECORDS = {User: UserRecord, Subscription: SubscriptionRecord}
+
+
 class ServerService:
+    INDEXES = [("servers", [("id", 1)], {"unique": True})]
+
     @staticmethod
     async def get_all() -> List[dict]:
         return await db.servers.find().to_list(None)
@@ -150,14 +318,273 @@ class ServerService:
         return await db.servers.update_one({"id": data["id"]}, {"$set": data})
 
 
+class LinkService:
+    INDEXES = [("links", [("user_id", 1), ("server_id", 1)], {"unique": True})]
+
+    @staticmethod
+    async def get(user_id: int, server_id: str) -> Optional[dict]:
+        return await db.links.find_one({"user_id": user_id, "server_id": server_id})
+
+    @staticmethod
+    async def upsert(link: dict) -> None:
+        link["updated_at"] = datetime.utcnow()
+        await db.links.update_one(
+            {"user_id": link["user_id"], "server_id": link["server_id"]},
+            {"$set": link},
+            upsert=True,
+        )
+
+
+class TrafficService:
+    INITIALIZED = False
+
+    @staticmethod
+    async def init() -> None:
+        if "traffic" not in await db.list_collection_names():
+            await db.create_collection(
+                "traffic",
+                timeseries={
+                    "timeField": "time",
+                    "metaField": "meta",
+                    "granularity": "minutes",
+                },
+                expireAfterSeconds=config.TRAFFIC_TIMESERIES_TTL,
+            )
+        TrafficService.INITIALIZED = True
+
+    @staticmethod
+    async def insert_many(samples: List[dict]) -> None:
+        if not samples:
+            return
+
+        try:
+            if not TrafficService.INITIALIZED:
+                await TrafficService.init()
+
+            await db.traffic.insert_many(samples, ordered=False)
+        except Exception as e:
+            logger.error(f"failed to store traffic samples: {e}")
+
+
+class OutboxService:
+    PENDING = "pending"
+    PROCESSING = "processing"
+    FAILED = "failed"
+
+    # Будит воркеры сразу после постановки в очередь, без ожидания опроса
+    WAKEUP = asyncio.Event()
+
+    INDEXES = [
+        # Не больше одной ожидающей мутации на пользователя — они сливаются
+        (
+            "outbox",
+            [("user_id", 1)],
+            {
+                "unique": True,
+                "partialFilterExpression": {"status": PENDING},
+                "name": "user_id_pending",
+            },
+        ),
+        # И не больше одной применяемой: новое состояние ждет, пока старое дойдет
+        (
+            "outbox",
+            [("user_id", 1)],
+            {
+                "unique": True,
+                "partialFilterExpression": {"status": PROCESSING},
+                "name": "user_id_processing",
+            },
+        ),
+        ("outbox", [("status", 1), ("next_attempt", 1)], {}),
+    ]
+
+    @staticmethod
+    async def enqueue(
+        user_id: int, expire_time: datetime, enable: bool, session=None
+    ) -> None:
+        now = datetime.utcnow()
+
+        try:
+            await db.outbox.update_one(
+                {"user_id": user_id, "status": OutboxService.PENDING},
+                {
+                    "$set": {
+                        "expire_time": expire_time,
+                        "enable": enable,
+                        "attempts": 0,
+                        "next_attempt": now,
+                        "updated_at": now,
+                    },
+                    "$setOnInsert": {"created_at": now},
+                },
+                upsert=True,
+                session=session,
+            )
+        except DuplicateKeyError:
+            if session is not None:
+                raise
+
+            # Параллельный upsert уже создал запись — повторяем как обновление
+            await OutboxService.enqueue(user_id, expire_time, enable)
+            return
+
+        OutboxService.WAKEUP.set()
+
+    @staticmethod
+    async def claim() -> Optional[dict]:
+        while True:
+            now = datetime.utcnow()
+
+            # Пользователи, чьи мутации сейчас применяются: иначе старое и новое
+            # состояние уйдут на панели одновременно и победит последнее дошедшее
+            busy = await db.outbox.distinct(
+                "user_id", {"status": OutboxService.PROCESSING}
+            )
+
+            try:
+                return await db.outbox.find_one_and_update(
+                    {
+                        "status": OutboxService.PENDING,
+                        "next_attempt": {"$lte": now},
+                        "user_id": {"$nin": busy},
+                    },
+                    {"$set": {"status": OutboxService.PROCESSING, "claimed_at": now}},
+                    sort=[("next_attempt", 1)],
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                # Другой воркер взял мутацию этого пользователя после чтения busy
+                continue
+
+    @staticmethod
+    async def superseded(item: dict) -> bool:
+        # Более новое состояние пользователя, поставленное во время обработки
+        return (
+            await db.outbox.find_one(
+                {
+                    "user_id": item["user_id"],
+                    "_id": {"$ne": item["_id"]},
+                    "status": {"$in": [OutboxService.PENDING, OutboxService.PROCESSING]},
+                },
+                {"_id": 1},
+            )
+            is not None
+        )
+
+    @staticmethod
+    async def complete(item: dict) -> None:
+        await db.outbox.delete_one({"_id": item["_id"]})
+
+    @staticmethod
+    async def retry(item: dict, error: str) -> None:
+        if await OutboxService.superseded(item):
+            await OutboxService.complete(item)
+            return
+
+        attempts = item["attempts"] + 1
+
+        if attempts >= config.OUTBOX_MAX_ATTEMPTS:
+            status = OutboxService.FAILED
+        else:
+            status = OutboxService.PENDING
+
+        delay = min(
+            config.OUTBOX_BACKOFF_BASE * 2 ** item["attempts"], config.OUTBOX_BACKOFF_MAX
+        )
+
+        try:
+            await db.outbox.update_one(
+                {"_id": item["_id"]},
+                {
+                    "$set": {
+                        "status": status,
+                        "attempts": attempts,
+                        "next_attempt": datetime.utcnow() + timedelta(seconds=delay),
+                        "last_error": error,
+                    }
+                },
+            )
+        except DuplicateKeyError:
+            # Пока запись обрабатывалась, пришло более новое состояние пользователя
+            await OutboxService.complete(item)
+
+    @staticmethod
+    async def release_stale() -> int:
+        # Записи, которые остались в обработке после падения процесса
+        stale = await db.outbox.find(
+            {
+                "status": OutboxService.PROCESSING,
+                "claimed_at": {
+                    "$lt": datetime.utcnow()
+                    - timedelta(seconds=config.OUTBOX_STALE_TIMEOUT)
+                },
+            }
+        ).to_list(None)
+
+        released = 0
+
+        for item in stale:
+            if await OutboxService.superseded(item):
+                await OutboxService.complete(item)
+                continue
+
+            try:
+                await db.outbox.update_one(
+                    {"_id": item["_id"]}, {"$set": {"status": OutboxService.PENDING}}
+                )
+                released += 1
+            except DuplicateKeyError:
+                await OutboxService.complete(item)
+
+        return released
+
+    @staticmethod
+    async def metrics() -> dict:
+        oldest = await reader("stats").outbox.find_one(
+            {"status": OutboxService.PENDING}, sort=[("created_at", 1)]
+        )
+
+        return {
+            "depth": await reader("stats").outbox.count_documents({"status": OutboxService.PENDING}),
+            "processing": await reader("stats").outbox.count_documents(
+                {"status": OutboxService.PROCESSING}
+            ),
+            "failed": await reader("stats").outbox.count_documents(
+                {"status": OutboxService.FAILED}
+            ),
+            "lag": (datetime.utcnow() - oldest["created_at"]).total_seconds()
+            if oldest
+            else 0.0,
+        }
+
+
 class UserService:
+    INDEXES = [
+        ("users", [("id", 1)], {"unique": True}),
+        ("users", [("referral_id", 1)], {}),
+        ("banned_users", [("id", 1)], {"unique": True}),
+    ]
+
+    # id забаненных пользователей, синхронизируется с banned_users через watch
+    BANNED = set()
+
+    # Пользователи по id; другие процессы видят изменения не позже USER_CACHE_TTL
+    CACHE = LRUCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+
     @staticmethod
     async def get(id: int) -> User:
-        user_data = await db.users.find_one({"id": id})
-        if user_data:
-            return User(**user_data)
-        else:
-            return None
+        user = UserService.CACHE.get(id)
+
+        if user is None:
+            user_data = await db.users.find_one({"id": id})
+            if not user_data:
+                return None
+
+            user = User(**user_data)
+            UserService.CACHE.put(id, user)
+
+        # Копия, чтобы изменения до upsert не попали в кэш
+        return user.model_copy()
 
     @staticmethod
     async def upsert(user: User) -> User:
@@ -165,28 +592,98 @@ class UserService:
             {"id": user.id}, {"$set": user.dict()}, upsert=True
         )
         if result:
-            return await UserService.get(user.id)
+            # Записанная модель и есть актуальное состояние, перечитывать не нужно
+            UserService.CACHE.put(user.id, user.model_copy())
+            return user
+
+    @staticmethod
+    async def iter_all(batch_size: int = None, lean: bool = False) -> AsyncIterator[User]:
+        # Курсор отдает пользователей пачками, вся коллекция в памяти не держится
+        async for user in reader("history").users.find(
+            {},
+            projection(User) if lean else None,
+            batch_size=batch_size or config.DB_BATCH_SIZE,
+        ):
+            yield load(User, user, lean)
 
     @staticmethod
-    async def get_all() -> List[User]:
-        users = await db.users.find().to_list(None)
-        return [User(**user) for user in users]
+    async def get_all(lean: bool = False) -> List[User]:
+        return [user async for user in UserService.iter_all(lean=lean)]
 
     @staticmethod
     async def count() -> int:
-        return await db.users.count_documents({})
+        return await reader("stats").users.count_documents({})
+
+    @staticmethod
+    async def estimated_count() -> int:
+        # Из метаданных коллекции, без обхода документов
+        return await reader("stats").users.estimated_document_count()
+
+    @staticmethod
+    def is_user_banned(id: int) -> bool:
+        return id in UserService.BANNED
 
     @staticmethod
-    async def is_user_banned(id: int) -> bool:
-        return await db.banned_users.find_one({"id": id}) is not None
+    async def load_bans() -> None:
+        UserService.BANNED = {
+            doc["id"] async for doc in db.banned_users.find({}, {"id": 1, "_id": 0})
+        }
 
     @staticmethod
     async def ban_user(id: int) -> None:
-        await db.banned_users.insert_one({"id": id})
+        # Повторный бан не должен падать на уникальном индексе
+        await db.banned_users.update_one({"id": id}, {"$set": {"id": id}}, upsert=True)
+        UserService.BANNED.add(id)
 
     @staticmethod
     async def unban_user(id: int) -> None:
         await db.banned_users.delete_one({"id": id})
+        UserService.BANNED.discard(id)
+
+    @staticmethod
+    async def debit(id: int, amount: float, session=None) -> Optional[User]:
+        # Проверка баланса и списание одной операцией, без гонки между ними
+        user_data = await db.users.find_one_and_update(
+            {"id": id, "balance": {"$gte": amount}},
+            {"$inc": {"balance": -amount, "total_spent": amount}},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+
+        return UserService.cached(user_data)
+
+    @staticmethod
+    async def credit(
+        id: int, amount: float, spent: float = 0.0, session=None
+    ) -> Optional[User]:
+        user_data = await db.users.find_one_and_update(
+            {"id": id},
+            {"$inc": {"balance": amount, "total_spent": spent}},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+
+        return UserService.cached(user_data)
+
+    @staticmethod
+    async def add_referral_days(id: int, days: int) -> Optional[User]:
+        user_data = await db.users.find_one_and_update(
+            {"id": id},
+            {"$inc": {"referral_days": days}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+        return UserService.cached(user_data)
+
+    @staticmethod
+    def cached(user_data: Optional[dict]) -> Optional[User]:
+        # Документ после атомарного обновления сразу кладется в кэш
+        if not user_data:
+            return None
+
+        user = User(**user_data)
+        UserService.CACHE.put(user.id, user.model_copy())
+        return user
 
     @staticmethod
     async def init_user(
@@ -217,23 +714,58 @@ class UserService:
         return user
 
     @staticmethod
-    async def get_subscribed_users() -> List[User]:
-        users = await db.users.find().to_list(None)
-        return [User(**user) for user in users if await User(**user).get_active_sub()]
-
+    async def iter_subscribed_users(
+        batch_size: int = None,
+    ) -> AsyncIterator[Tuple[User, "Subscription"]]:
+        """
+        Пользователи с активной подпиской вместе с этой подпиской.
+
+        Один агрегирующий запрос от активных подписок к пользователям; при
+        нескольких активных подписках берется та, что заканчивается позже.
+        Результат читается из курсора пачками по batch_size.
+        """
+        cursor = db.subscriptions.aggregate(
+            [
+                {"$match": {"datetime_end": {"$gt": datetime.utcnow()}}},
+                {"$sort": {"datetime_end": -1}},
+                {"$group": {"_id": "$user_id", "sub": {"$first": "$$ROOT"}}},
+                {
+                    "$lookup": {
+                        "from": "users",
+                        "localField": "_id",
+                        "foreignField": "id",
+                        "as": "user",
+                    }
+                },
+                {"$unwind": "$user"},
+            ],
+            allowDiskUse=True,
+            batchSize=batch_size or config.DB_BATCH_SIZE,
+        )
 
-class SubService:
-    POOL = []
+        async for doc in cursor:
+            yield User(**doc["user"]), Subscription(**doc["sub"])
 
     @staticmethod
-    async def fetch_prices() -> bool:
-        try:
-            SubService.POOL = await db.pricing.find().to_list(None)
-            logger.info("fetched prices")
-            return True
-        except Exception as e:
-            logger.error("failed to fetch prices: " + str(e))
-            return False
+    async def get_subscribed_users() -> List[Tuple[User, "Subscription"]]:
+        return [pair async for pair in UserService.iter_subscribed_users()]
+
+
+class SubService:
+    # Активная подписка по user_id: (подписка или None, когда запись устаревает)
+    ACTIVE = {}
+
+    INDEXES = [
+        ("subscriptions", [("user_id", 1), ("datetime_end", -1)], {}),
+        ("subscriptions", [("datetime_end", 1)], {}),
+        # Новая подписка ссылается на предыдущую, поэтому две покупки без активной
+        # подписки не создадут две параллельные; старые документы без поля не входят
+        (
+            "subscriptions",
+            [("user_id", 1), ("previous_id", 1)],
+            {"unique": True, "partialFilterExpression": {"previous_id": {"$exists": True}}},
+        ),
+    ]
 
     @staticmethod
     async def get(id: PyObjectId) -> Subscription:
@@ -244,105 +776,512 @@ class SubService:
             return None
 
     @staticmethod
-    async def upsert(sub: Subscription) -> Subscription:
+    async def get_active(user_id: int) -> Optional[Subscription]:
+        now = datetime.utcnow()
+
+        cached = SubService.ACTIVE.get(user_id)
+        if cached is None or cached[1] <= now:
+            # Одна подписка по индексу (user_id, datetime_end) вместо всей истории
+            sub_data = await db.subscriptions.find_one(
+                {"user_id": user_id, "datetime_end": {"$gt": now}},
+                sort=[("datetime_end", -1)],
+            )
+            sub = Subscription(**sub_data) if sub_data else None
+
+            # Активная запись истекает вместе с подпиской, отсутствие — по TTL
+            if sub:
+                expires = sub.datetime_end
+            else:
+                expires = now + timedelta(seconds=config.SUB_CACHE_TTL)
+
+            if len(SubService.ACTIVE) >= config.SUB_CACHE_SIZE:
+                SubService.ACTIVE = {
+                    key: value
+                    for key, value in SubService.ACTIVE.items()
+                    if value[1] > now
+                }
+                if len(SubService.ACTIVE) >= config.SUB_CACHE_SIZE:
+                    SubService.ACTIVE = {}
+
+            cached = SubService.ACTIVE[user_id] = (sub, expires)
+
+        # Копия, чтобы изменения вызывающего кода не попали в кэш
+        return cached[0].model_copy() if cached[0] else None
+
+    @staticmethod
+    def invalidate(user_id: int) -> None:
+        SubService.ACTIVE.pop(user_id, None)
+
+    @staticmethod
+    async def upsert(sub: Subscription, session=None) -> Subscription:
         result = await db.subscriptions.update_one(
-            {"_id": sub.id}, {"$set": sub.dict(by_alias=True)}, upsert=True
+            {"_id": sub.id},
+            {"$set": sub.dict(by_alias=True)},
+            upsert=True,
+            session=session,
         )
 
         if not result:
             return
 
-        is_sub_active = sub.active
-        user = await sub.get_user()
+        SubService.invalidate(sub.user_id)
+
+        # Панели обновляются воркерами outbox, обработчик не ждет их ответа
+        await OutboxService.enqueue(
+            sub.user_id, sub.datetime_end, sub.active, session=session
+        )
+
+        return sub
+
+    @staticmethod
+    async def extend(
+        user_id: int, days: int, plan: str, cost: float = 0.0, session=None
+    ) -> Subscription:
+        """
+        Продлевает активную подписку на days дней или создает новую.
+
+        Продление записывается условным update по старому datetime_end, так
+        что параллельные продления не затирают друг друга. Новая подписка
+        вставляется с previous_id последней подписки пользователя: из двух
+        параллельных вставок уникальный индекс пропустит одну, а вторая
+        продлит уже созданную. В транзакции DuplicateKeyError пробрасывается,
+        транзакцию повторяет purchase.
+        """
+        while True:
+            now = datetime.utcnow()
+
+            sub_data = await db.subscriptions.find_one(
+                {"user_id": user_id},
+                sort=[("datetime_end", -1)],
+                session=session,
+            )
+
+            if not sub_data or sub_data["datetime_end"] <= now:
+                sub = Subscription(
+                    user_id=user_id,
+                    datetime_start=now,
+                    datetime_end=now + timedelta(days=days),
+                    plan=plan,
+                    cost=cost,
+                )
+
+                try:
+                    await db.subscriptions.insert_one(
+                        {
+                            **sub.dict(by_alias=True),
+                            "previous_id": sub_data["_id"] if sub_data else None,
+                        },
+                        session=session,
+                    )
+                except DuplicateKeyError:
+                    if session is not None:
+                        raise
+                    continue
+
+                SubService.invalidate(user_id)
+                await OutboxService.enqueue(
+                    user_id, sub.datetime_end, True, session=session
+                )
+                return sub
+
+            sub = Subscription(**sub_data)
+            datetime_end = sub.datetime_end + timedelta(days=days)
+
+            result = await db.subscriptions.update_one(
+                {"_id": sub.id, "datetime_end": sub.datetime_end},
+                {"$set": {"datetime_end": datetime_end}},
+                session=session,
+            )
 
-        from network import upsert_client
+            if result.modified_count:
+                sub.datetime_end = datetime_end
+                SubService.invalidate(user_id)
+                await OutboxService.enqueue(user_id, datetime_end, True, session=session)
+                return sub
 
-        await upsert_client(sub.datetime_end, user, is_sub_active)
+    @staticmethod
+    async def purchase(
+        user_id: int, price: float, days: int, plan: str
+    ) -> Optional[Subscription]:
+        """
+        Списывает price с баланса и продлевает или создает подписку.
+
+        Возвращает None, если денег не хватает. С MONGODB_TRANSACTIONS списание,
+        подписка и запись в outbox фиксируются одной транзакцией; без нее при
+        ошибке записи подписки деньги возвращаются.
+        """
+
+        async def operation(session):
+            if not await UserService.debit(user_id, price, session=session):
+                return None
+
+            try:
+                return await SubService.extend(
+                    user_id, days, plan, cost=price, session=session
+                )
+            except Exception:
+                if session is None:
+                    await UserService.credit(user_id, price, spent=-price)
+                raise
 
-        return await SubService.get(result.upserted_id)
+        try:
+            while True:
+                try:
+                    sub = await transaction(operation)
+                    break
+                except DuplicateKeyError:
+                    # Параллельная покупка создала подписку первой, списание
+                    # откатилось вместе с транзакцией; повторяем с продлением
+                    logger.info(f"retrying purchase for {user_id} after concurrent insert")
+        finally:
+            # Кэши могли прочитать состояние до фиксации транзакции
+            UserService.CACHE.pop(user_id)
+            SubService.invalidate(user_id)
+
+        if sub:
+            OutboxService.WAKEUP.set()
+
+        return sub
 
     @staticmethod
     async def remove(sub: Subscription) -> None:
         await db.subscriptions.delete_one({"_id": sub.id})
+        SubService.invalidate(sub.user_id)
 
-        from network import upsert_client
-
-        await upsert_client(sub.datetime_end, await sub.get_user(), False)
+        await OutboxService.enqueue(sub.user_id, sub.datetime_end, False)
 
     @staticmethod
-    async def get_by_end_date(end_date: datetime) -> List[Subscription]:
+    async def get_by_end_date(
+        end_date: datetime, lean: bool = False
+    ) -> List[Subscription]:
         # Создаем объект даты для начала и конца дня
         start_of_day = datetime(end_date.year, end_date.month, end_date.day)
         end_of_day = start_of_day + timedelta(days=1)
 
         # Ищем подписки, которые закончились в этот день
-        sub_data = await db.subscriptions.find(
-            {"datetime_end": {"$gte": start_of_day, "$lt": end_of_day}}
+        sub_data = await reader("history").subscriptions.find(
+            {"datetime_end": {"$gte": start_of_day, "$lt": end_of_day}},
+            projection(Subscription) if lean else None,
         ).to_list(None)
 
         # Преобразуем данные подписок в объекты Subscription и возвращаем их
-        return [Subscription(**sub) for sub in sub_data]
+        return [load(Subscription, sub, lean) for sub in sub_data]
 
     @staticmethod
-    async def get_expiring_subs() -> List[Subscription]:
+    async def iter_expiring(
+        batch_size: int = None, lean: bool = False
+    ) -> AsyncIterator[Subscription]:
         now = datetime.utcnow()
         start = datetime(now.year, now.month, now.day)
         end = start + timedelta(days=5)
 
-        sub_data = await db.subscriptions.find(
-            {"datetime_end": {"$gte": start, "$lt": end}}
-        ).to_list(None)
+        async for sub in reader("history").subscriptions.find(
+            {"datetime_end": {"$gte": start, "$lt": end}},
+            projection(Subscription) if lean else None,
+            batch_size=batch_size or config.DB_BATCH_SIZE,
+        ):
+            yield load(Subscription, sub, lean)
+
+    @staticmethod
+    async def get_expiring_subs(lean: bool = False) -> List[Subscription]:
+        return [sub async for sub in SubService.iter_expiring(lean=lean)]
+
+    @staticmethod
+    async def iter_active(
+        batch_size: int = None, lean: bool = False
+    ) -> AsyncIterator[Subscription]:
+        async for sub in db.subscriptions.find(
+            {"datetime_end": {"$gte": datetime.utcnow()}},
+            projection(Subscription) if lean else None,
+            batch_size=batch_size or config.DB_BATCH_SIZE,
+        ):
+            yield load(Subscription, sub, lean)
 
-        return [Subscription(**sub) for sub in sub_data]
+    @staticmethod
+    async def get_all_active(lean: bool = False) -> List[Subscription]:
+        return [sub async for sub in SubService.iter_active(lean=lean)]
 
     @staticmethod
-    async def get_all_active() -> List[Subscription]:
-        sub_data = await db.subscriptions.find(
+    async def count_active() -> int:
+        # Считается по индексу datetime_end, документы не читаются
+        return await reader("stats").subscriptions.count_documents(
             {"datetime_end": {"$gte": datetime.utcnow()}}
-        ).to_list(None)
-        return [Subscription(**sub) for sub in sub_data]
+        )
 
 
 class CouponService:
+    INDEXES = [
+        ("coupons", [("id", 1)], {"unique": True}),
+        ("coupon_redemptions", [("coupon_id", 1), ("user_id", 1)], {"unique": True}),
+    ]
+
     @staticmethod
-    async def get_valid(id: str, user_id: int) -> dict:
-        coupon = await db.coupons.find_one({"id": id})
+    async def redeem(id: str, user_id: int) -> Optional[dict]:
+        """
+        Активирует купон для пользователя и возвращает его без activated_by.
+
+        Повторная активация отсекается уникальным индексом coupon_redemptions,
+        срок, лимит и старый список activated_by проверяются одним условным
+        find_one_and_update, так что стоимость не растет с числом активаций.
+        """
+
+        async def operation(session):
+            # DuplicateKeyError прерывает транзакцию на сервере, поэтому
+            # ловится снаружи, после ее отката
+            await db.coupon_redemptions.insert_one(
+                {"coupon_id": id, "user_id": user_id, "time": datetime.utcnow()},
+                session=session,
+            )
 
-        if not coupon:
-            logger.info(f"tried to activate coupon {id} that does not exist")
-            return
+            coupon = await db.coupons.find_one_and_update(
+                {
+                    "id": id,
+                    "limit": {"$ne": 0},
+                    "$or": [{"expire_date": 0}, {"expire_date": {"$gt": datetime.now()}}],
+                    "activated_by": {"$ne": user_id},
+                },
+                # limit < 0 — купон без ограничений, его не уменьшаем
+                [
+                    {
+                        "$set": {
+                            "limit": {
+                                "$cond": [
+                                    {"$gt": ["$limit", 0]},
+                                    {"$subtract": ["$limit", 1]},
+                                    "$limit",
+                                ]
+                            }
+                        }
+                    }
+                ],
+                projection={"activated_by": 0},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
 
-        if coupon["limit"] == 0:
-            logger.info(f"tried to activate coupon {id} with limit == 0")
-            return
+            if not coupon:
+                logger.info(f"tried to activate missing, expired or used up coupon {id}")
+
+                await db.coupon_redemptions.delete_one(
+                    {"coupon_id": id, "user_id": user_id}, session=session
+                )
 
-        if coupon["expire_date"] != 0:
-            if coupon["expire_date"] < datetime.now():
-                logger.info(f"tried to activate expired coupon {id}")
-                return
+            return coupon
 
-        if coupon["activated_by"] and user_id in coupon["activated_by"]:
+        try:
+            return await transaction(operation)
+        except DuplicateKeyError:
             logger.info(
                 f"tried to activate coupon {id} that was already activated by user {user_id}"
             )
-            return
+            return None
 
-        return coupon
 
-    @staticmethod
-    async def activate(id: str, user_id: int) -> None:
-        coupon = await CouponService.get_valid(id, user_id)
+SERVICES = [
+    WalletService,
+    ServerService,
+    LinkService,
+    OutboxService,
+    UserService,
+    SubService,
+    CouponService,
+]
+
+# Типичные запросы сервисов для проверки планов: (коллекция, фильтр, сортировка)
+QUERIES = [
+    ("users", {"id": 0}, None),
+    ("users", {"referral_id": 0}, None),
+    ("banned_users", {"id": 0}, None),
+    ("subscriptions", {"user_id": 0}, [("datetime_end", -1)]),
+    (
+        "subscriptions",
+        {"user_id": 0, "datetime_end": {"$gt": datetime(2000, 1, 1)}},
+        None,
+    ),
+    ("subscriptions", {"datetime_end": {"$gte": datetime(2000, 1, 1)}}, None),
+    ("outbox", {"status": "pending"}, [("created_at", 1)]),
+    ("wallets", {"order_id": "0"}, None),
+    ("wallets", {"order_id": "0", "currency": "USDT"}, None),
+    ("coupons", {"id": ""}, None),
+    ("coupon_redemptions", {"coupon_id": "", "user_id": 0}, None),
+    ("servers", {"id": ""}, None),
+    ("links", {"user_id": 0, "server_id": ""}, None),
+    (
+        "outbox",
+        {"status": "pending", "next_attempt": {"$lte": datetime(2000, 1, 1)}},
+        [("next_attempt", 1)],
+    ),
+]
+
+
+WATCHERS: List[asyncio.Task] = []
+
+
+async def transaction(operation):
+    """
+    Выполняет operation(session) в транзакции MongoDB.
+
+    Транзакции требуют replica set, поэтому включаются MONGODB_TRANSACTIONS;
+    без него operation получает session=None и выполняется как есть.
+    """
+    if not config.MONGODB_TRANSACTIONS:
+        return await operation(None)
+
+    async with await db_client.start_session() as session:
+        return await session.with_transaction(operation)
+
+
+async def watch(collection: str, reload, interval: float) -> None:
+    """
+    Вызывает reload() при каждом изменении коллекции.
+
+    Использует change stream; если он недоступен (MongoDB без replica set),
+    переходит на перезагрузку каждые interval секунд.
+    """
+    async def poll():
+        await asyncio.sleep(interval)
+
+        try:
+            await reload()
+        except Exception as e:
+            logger.error(f"failed to reload {collection}: {e}")
 
-        if not coupon:
+    while True:
+        try:
+            async with db[collection].watch() as stream:
+                # Изменения, пропущенные до открытия потока
+                await reload()
+
+                async for _ in stream:
+                    await reload()
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            logger.info(f"no change streams for {collection}, polling every {interval}s: {e}")
+            break
+        except Exception as e:
+            # Пока поток недоступен, данные все равно обновляются
+            logger.error(f"watcher of {collection} failed: {e}")
+            await poll()
+
+    while True:
+        await poll()
+
+
+def start_watcher(collection: str, reload, interval: float) -> None:
+    WATCHERS.append(asyncio.create_task(watch(collection, reload, interval)))
+
+
+async def rebuild_index(collection: str, keys: list, options: dict) -> None:
+    """
+    Приводит индекс с объявленным именем к новым опциям.
+
+    Уникальность включается через collMod (MongoDB 6.0+) без удаления
+    индекса: при дубликатах старый индекс остается. Иначе индекс удаляется
+    и создается заново, а если новый не собрался, возвращается старый.
+    Индексы с другими именами на том же ключе не трогаются.
+    """
+    name = options.get("name") or "_".join(f"{key}_{direction}" for key, direction in keys)
+    existing = (await db[collection].index_information()).get(name)
+
+    if existing is None:
+        raise OperationFailure(f"no index {name} on {collection} to rebuild")
+
+    old = {
+        option: value
+        for option, value in existing.items()
+        if option not in ("key", "v", "ns")
+    }
+    new = {option: value for option, value in options.items() if option != "name"}
+
+    if {**old, "unique": True} == new and old.get("unique") is not True:
+        try:
+            for option in ("prepareUnique", "unique"):
+                await db.command(
+                    {"collMod": collection, "index": {"name": name, option: True}}
+                )
             return
+        except OperationFailure as e:
+            # CannotConvertIndexToUnique: есть дубликаты, старый индекс на месте
+            # (и уже не пускает новые); остальное — MongoDB старше 6.0
+            if e.code == 359:
+                raise
+
+    await db[collection].drop_index(name)
+
+    try:
+        await db[collection].create_index(keys, name=name, **new)
+    except Exception:
+        await db[collection].create_index(keys, name=name, **old)
+        raise
+
+
+async def ensure_indexes() -> int:
+    """
+    Создает индексы, объявленные в INDEXES сервисов.
+
+    create_index ничего не делает, если такой индекс уже есть, поэтому
+    вызывается на каждом запуске. Ошибка одного индекса (например, дубликаты
+    под уникальным) логируется и не мешает остальным.
+    """
+    created = 0
+
+    for service in SERVICES:
+        for collection, keys, options in service.INDEXES:
+            try:
+                try:
+                    await db[collection].create_index(keys, **options)
+                except OperationFailure as e:
+                    # Индекс с тем же ключом, но другими опциями (например, стал
+                    # уникальным): create_index его не меняет, пересоздаем
+                    if e.code not in (85, 86):
+                        raise
+
+                    await rebuild_index(collection, keys, options)
+                    logger.info(f"recreated index {keys} on {collection}")
+
+                created += 1
+            except Exception as e:
+                logger.error(f"failed to create index {keys} on {collection}: {e}")
+
+    logger.info(f"ensured {created} indexes")
+
+    return created
+
+
+def find_stage(plan: dict, stage: str) -> bool:
+    if plan.get("stage") == stage:
+        return True
+
+    children = plan.get("inputStages", []) + [
+        plan[key] for key in ("inputStage", "queryPlan") if key in plan
+    ]
+
+    return any(find_stage(child, stage) for child in children)
+
+
+async def explain_queries() -> List[dict]:
+    # Диагностика: план каждого запроса из QUERIES, полные сканирования в лог
+    reports = []
+
+    for collection, query, sort in QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        try:
+            plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        except Exception as e:
+            logger.error(f"failed to explain {collection} {query}: {e}")
+            continue
 
-        if coupon["limit"] > 0:
-            coupon["limit"] -= 1
+        collscan = find_stage(plan, "COLLSCAN")
+        reports.append({"collection": collection, "query": query, "collscan": collscan})
 
-        # Update the coupon to include the user ID in the activated_by array
-        coupon["activated_by"].append(user_id)
+        if collscan:
+            logger.warning(f"collection scan on {collection} for {query}")
 
-        await db.coupons.update_one({"id": id}, {"$set": coupon})
+    return reports
 
 
 async def initialize_subscriptions():
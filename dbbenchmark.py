@@ -0,0 +1,193 @@
+"""
+    Нагрузочный тест операций с MongoDB.
+
+    Работает с отдельной базой (--db, по умолчанию blazevpn_benchmark),
+    которая очищается перед сценарием. Печатает ops/s и задержки p50/p99
+    и проверяет, что параллельные операции не нарушили инварианты.
+
+    Запуск: python dbbenchmark.py purchase --users 100 --ops 5000 --concurrency 50
+            python dbbenchmark.py coupons --users 10000 --ops 20000 --legacy 50000
+            python dbbenchmark.py lean --docs 100000 --ops 5
+"""
+
+import random
+import asyncio
+import logging
+import argparse
+
+from datetime import datetime, timedelta
+
+import database
+
+from benchmark import measure
+from database import CouponService, SubService, User, UserService
+from logger import logger
+
+
+async def bench_purchase(args):
+    price = 5.0
+    affordable = 10
+
+    await database.ensure_indexes()
+    await database.db.users.insert_many(
+        [
+            User(id=i, balance=price * affordable, uuid=str(i)).dict()
+            for i in range(args.users)
+        ]
+    )
+
+    bought = 0
+
+    async def purchase(i):
+        nonlocal bought
+
+        if await SubService.purchase(random.randrange(args.users), price, 1, "bench"):
+            bought += 1
+
+    await measure("purchase", args.users, args.ops, args.concurrency, purchase)
+
+    # Деньги не теряются и не уходят в минус, каждая покупка дала день
+    # подписки, и у пользователя ровно одна подписка, а не несколько параллельных
+    errors = 0
+    now = datetime.utcnow()
+
+    async for user in database.db.users.find():
+        spent = round(user["total_spent"] / price)
+        subs = await database.db.subscriptions.find({"user_id": user["id"]}).to_list(None)
+        days = sum(
+            round((sub["datetime_end"] - now).total_seconds() / 86400) for sub in subs
+        )
+
+        if (
+            user["balance"] < 0
+            or user["balance"] + user["total_spent"] != price * affordable
+            or days != spent
+            or len(subs) != min(spent, 1)
+        ):
+            errors += 1
+
+    total_spent = sum(
+        [user["total_spent"] async for user in database.db.users.find()]
+    )
+
+    print(
+        f"purchases: {bought} succeeded, {args.ops - bought} declined, "
+        f"{round(total_spent / price)} charged, {errors} users with broken invariants"
+    )
+
+
+async def bench_coupons(args):
+    limit = args.users // 2
+
+    await database.ensure_indexes()
+
+    # Старый формат: тысячи активаций в activated_by внутри документа купона
+    await database.db.coupons.insert_one(
+        {
+            "id": "BENCH",
+            "limit": limit,
+            "expire_date": 0,
+            "value": 1.0,
+            "activated_by": [-i for i in range(1, args.legacy + 1)],
+        }
+    )
+
+    redeemed = 0
+
+    async def redeem(i):
+        nonlocal redeemed
+
+        user_id = random.choice([-1, random.randrange(args.users)])
+        if await CouponService.redeem("BENCH", user_id):
+            redeemed += 1
+
+    await measure("coupon redeem", args.legacy, args.ops, args.concurrency, redeem)
+
+    coupon = await database.db.coupons.find_one({"id": "BENCH"})
+    redemptions = await database.db.coupon_redemptions.count_documents({})
+    legacy = await database.db.coupon_redemptions.count_documents({"user_id": -1})
+
+    print(
+        f"coupons: {redeemed} redeemed, {redemptions} stored, limit left {coupon['limit']} "
+        f"(expected {limit - redemptions}), legacy user redeemed {legacy} times"
+    )
+
+
+async def bench_lean(args):
+    now = datetime.utcnow()
+
+    for start in range(0, args.docs, 10000):
+        ids = range(start, min(start + 10000, args.docs))
+
+        await database.db.users.insert_many(
+            [User(id=i, uuid=str(i)).dict() for i in ids]
+        )
+        await database.db.subscriptions.insert_many(
+            [
+                {
+                    "user_id": i,
+                    "datetime_start": now,
+                    "datetime_end": now + timedelta(days=30),
+                    "plan": "bench",
+                    "cost": 5.0,
+                }
+                for i in ids
+            ]
+        )
+
+    for lean in (False, True):
+        mode = "lean" if lean else "validated"
+
+        await measure(
+            f"users get_all {mode}",
+            args.docs,
+            args.ops,
+            1,
+            lambda i: UserService.get_all(lean=lean),
+        )
+        await measure(
+            f"subs get_all_active {mode}",
+            args.docs,
+            args.ops,
+            1,
+            lambda i: SubService.get_all_active(lean=lean),
+        )
+
+
+SCENARIOS = {
+    "purchase": bench_purchase,
+    "coupons": bench_coupons,
+    "lean": bench_lean,
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="database benchmark")
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("--db", default="blazevpn_benchmark")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--legacy", type=int, default=50000)
+    parser.add_argument("--docs", type=int, default=100000)
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    # Сервисы обращаются к database.db при каждом вызове, подменяем базу целиком
+    await database.db_client.drop_database(args.db)
+    database.db = database.db_client[args.db]
+
+    print(
+        f"{'operation':<24} {'size':>8} {'ops':>8} {'ops/s':>10} "
+        f"{'p50 ms':>10} {'p99 ms':>10}"
+    )
+
+    try:
+        await SCENARIOS[args.scenario](args)
+    finally:
+        await database.db_client.drop_database(args.db)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
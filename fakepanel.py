@@ -0,0 +1,221 @@
+"""
+    Локальная замена панели 3x-ui для нагрузочных тестов network.py.
+
+    Реализует эндпоинты, которые использует panel.Panel: логин, список
+    инбаундов, get/addClient/updateClient и статус сервера. Задержка ответа
+    и доля ошибок настраиваются, чтобы проверять дедлайны и предохранитель.
+
+    Запуск: python fakepanel.py --clients 10000 --latency 0.05 --failure-rate 0.01
+"""
+
+import json
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+SESSION = "fakepanel"
+
+
+class FakePanel:
+    def __init__(
+        self,
+        clients: int = 1000,
+        inbound_id: int = 2,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        failure_rate: float = 0.0,
+        username: str = "admin",
+        password: str = "admin",
+    ):
+        self.inbound_id = inbound_id
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.username = username
+        self.password = password
+
+        self.clients = {}
+        self.requests = 0
+        self._settings = None  # сериализованные настройки, сбрасываются при изменении
+
+        for i in range(clients):
+            self.put_client(
+                {
+                    "id": f"00000000-0000-4000-8000-{i:012d}",
+                    "email": str(1000000 + i),
+                    "enable": True,
+                    "flow": "xtls-rprx-vision",
+                    "limitIp": 5,
+                    "totalGB": 0,
+                    "expiryTime": 0,
+                    "tgId": "",
+                    "subId": "",
+                }
+            )
+
+    def put_client(self, client: dict) -> None:
+        self.clients[str(client["email"])] = client
+        self._settings = None
+
+    def inbounds(self) -> list:
+        if self._settings is None:
+            self._settings = json.dumps(
+                {
+                    "clients": list(self.clients.values()),
+                    "decryption": "none",
+                    "fallbacks": [],
+                }
+            )
+
+        stream = {
+            "network": "tcp",
+            "security": "reality",
+            "realitySettings": {
+                "serverNames": ["www.example.com"],
+                "shortIds": ["6ba85179e30d4fc2"],
+                "settings": {"publicKey": "fake-public-key", "fingerprint": "chrome"},
+            },
+        }
+
+        return [
+            {
+                "id": 1,
+                "port": 80,
+                "up": 0,
+                "down": 0,
+                "settings": json.dumps({"clients": []}),
+                "streamSettings": json.dumps({"network": "tcp"}),
+            },
+            {
+                "id": self.inbound_id,
+                "port": 443,
+                "up": self.requests * 1024,
+                "down": self.requests * 4096,
+                "settings": self._settings,
+                "streamSettings": json.dumps(stream),
+            },
+        ]
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if self.failure_rate and random.random() < self.failure_rate:
+            return web.json_response(
+                {"success": False, "msg": "injected failure"}, status=500
+            )
+
+        if request.path != "/login" and request.cookies.get("session") != SESSION:
+            if request.path.startswith("/server"):
+                return web.json_response({"success": False}, status=401)
+            raise web.HTTPFound("/login")
+
+        return await handler(request)
+
+    async def login(self, request):
+        data = await request.post()
+
+        if data.get("username") != self.username or data.get("password") != self.password:
+            return web.json_response({"success": False, "msg": "wrong credentials"})
+
+        response = web.json_response({"success": True, "msg": "Login Successfully"})
+        response.set_cookie("session", SESSION)
+        return response
+
+    async def list_inbounds(self, request):
+        return web.json_response({"success": True, "obj": self.inbounds()})
+
+    async def get_inbound(self, request):
+        inbound_id = int(request.match_info["id"])
+
+        for inbound in self.inbounds():
+            if inbound["id"] == inbound_id:
+                return web.json_response({"success": True, "obj": inbound})
+
+        return web.json_response({"success": False, "msg": "not found"})
+
+    async def add_client(self, request):
+        data = await request.post()
+        clients = json.loads(data["settings"])["clients"]
+
+        for client in clients:
+            if str(client["email"]) in self.clients:
+                return web.json_response(
+                    {"success": False, "msg": f"Duplicate email: {client['email']}"}
+                )
+
+        for client in clients:
+            self.put_client(client)
+
+        return web.json_response({"success": True, "msg": "Client(s) added"})
+
+    async def update_client(self, request):
+        data = await request.post()
+        client = json.loads(data["settings"])["clients"][0]
+
+        for email, existing in list(self.clients.items()):
+            if existing["id"] == request.match_info["id"]:
+                del self.clients[email]
+                self.put_client(client)
+                return web.json_response({"success": True, "msg": "Client updated"})
+
+        return web.json_response({"success": False, "msg": "client not found"})
+
+    async def status(self, request):
+        return web.json_response(
+            {"success": True, "obj": {"cpu": 1.0, "uptime": self.requests}}
+        )
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+
+        app.router.add_post("/login", self.login)
+        app.router.add_post("/server/status", self.status)
+
+        for api_path, list_path in (("panel/api", "list"), ("xui/API", "")):
+            app.router.add_get(f"/{api_path}/inbounds/{list_path}", self.list_inbounds)
+            app.router.add_get(f"/{api_path}/inbounds/get/{{id}}", self.get_inbound)
+            app.router.add_post(f"/{api_path}/inbounds/addClient", self.add_client)
+            app.router.add_post(
+                f"/{api_path}/inbounds/updateClient/{{id}}", self.update_client
+            )
+
+        return app
+
+
+async def start(panel: FakePanel, host: str = "127.0.0.1", port: int = 0):
+    runner = web.AppRunner(panel.app(), access_log=None)
+    await runner.setup()
+
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    # При port=0 порт выбирает система
+    port = runner.addresses[0][1]
+
+    return runner, f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fake 3x-ui panel")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    panel = FakePanel(
+        clients=args.clients,
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+    )
+
+    web.run_app(panel.app(), host=args.host, port=args.port)
@@ -6,6 +6,10 @@ from aiohttp.web import AppRunner, TCPSite
 import telegram
 import server
 import network
+import outbox
+import database
+import pricing
+import config
 
 from logger import logger
 
@@ -27,7 +31,18 @@ async def start_aiohttp_server(app):
 async def main():
     app = await server.main()  # Запуск aiohttp сервера
 
+    await database.ensure_indexes()
+    await database.UserService.load_bans()
+    database.start_watcher(
+        "banned_users", database.UserService.load_bans, config.BAN_POLL_INTERVAL
+    )
+    await pricing.reload()
+    database.start_watcher("pricing", pricing.reload, config.PRICING_POLL_INTERVAL)
+    if config.MONGODB_EXPLAIN:
+        await database.explain_queries()  # Предупреждения о полных сканированиях
+
     await network.login_all()
+    await outbox.start()  # Воркеры, применяющие изменения клиентов на панелях
 
     bot_task = asyncio.create_task(telegram.main())  # Запуск телеграм бота
     server_task = asyncio.create_task(
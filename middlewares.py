@@ -1,12 +1,13 @@
 from aiogram import types, BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, Message
 
 import database
 
 
 class BanMiddleware(BaseMiddleware):
     async def __call__(self, handler, message: types.Message, data: dict):
-        if isinstance(message, Message):
-            if await database.UserService.is_user_banned(message.from_user.id):
+        if isinstance(message, (Message, CallbackQuery)) and message.from_user:
+            # Проверка по множеству в памяти, без запроса к базе
+            if database.UserService.is_user_banned(message.from_user.id):
                 return  # Прерываем обработку
         return await handler(message, data)  # Продолжаем обработку
@@ -1,240 +1,533 @@
 ﻿from datetime import datetime, timedelta
 from inspect import getabsfile
-from pyxui import XUI, xui
 from pyxui.errors import BadLogin, NotFound
 from aiogram.types import Message
 from urllib.parse import urlparse
+from typing import AsyncIterator, Dict, Iterable, List
 from pyxui.config_gen import config_generator
 
 import asyncio
 import json
+import time
 import aiocron
 from requests import HTTPError
 
-from database import Subscription, User, db, ServerService, UserService
+import config
+
+from database import (
+    Subscription,
+    User,
+    db,
+    LinkService,
+    ServerService,
+    UserService,
+)
 from logger import logger
+from panel import PanelError, client_settings
 
-LAST_UPDATE = 0
+import registry
 
 
-async def login_to_server(server_info):
-    xui = XUI(
-        full_address=server_info["full_address"],
-        panel=server_info["panel"],
-        https=False,
-    )
+async def login_all():
+    logger.info(f"start...")
+
+    # Полный повторный логин на всех серверах (команда /login и запуск бота)
+    return await registry.refresh(force_login=True)
+
+
+async def run_on_server(operation, xui, server_info, deadline: float) -> dict:
+    started = time.monotonic()
+    report = {
+        "server": server_info["id"],
+        "server_info": server_info,
+        "full_address": server_info["full_address"],
+        "ok": False,
+        "result": None,
+        "error": None,
+        "elapsed": 0.0,
+    }
+
+    async def run():
+        # Ограничиваем число одновременных запросов к одной панели
+        async with xui.semaphore:
+            return await operation(xui, server_info)
 
     try:
-        # Попытка выполнить синхронный вызов login в отдельном потоке
-        await asyncio.to_thread(
-            xui.login, server_info["username"], server_info["password"]
-        )
-        logger.info(f"{server_info['id']}: successful login")
+        report["result"] = await asyncio.wait_for(run(), timeout=deadline)
+        report["ok"] = True
+    except asyncio.TimeoutError:
+        xui.breaker.record(False)
+        report["error"] = f"deadline of {deadline}s exceeded"
+    except Exception as e:
+        report["error"] = str(e) or type(e).__name__
+
+    report["elapsed"] = time.monotonic() - started
+
+    return report
 
-        if server_info["new"]:
-            logger.info(
-                f"Detected new server ({server_info['id']}), updating clients..."
-            )
 
-            active_users = await UserService.get_subscribed_users()
-            logger.info(f"found {len(active_users)} active users")
+async def fan_out(operation, deadline: float = None) -> List[dict]:
+    """
+    Выполняет operation(xui, server_info) одновременно на всех доступных серверах.
 
-            for user in active_users:
-                sub = await user.get_active_sub()
+    Возвращает отчет по каждому серверу: ok, result, error, elapsed.
+    Медленная панель ограничена deadline и не задерживает остальные.
+    """
+    if deadline is None:
+        deadline = config.XUI_FANOUT_DEADLINE
 
-                if sub is not None:
-                    await upsert_client(sub.datetime_end, user, True)
-                    logger.info(f"{server_info['id']}: upserted client #{user.id}")
+    # Недоступные серверы и серверы с открытым предохранителем пропускаются сразу
+    tasks = [
+        run_on_server(operation, state.xui, state.info, deadline)
+        for state in registry.REGISTRY.available()
+    ]
 
-            server_info["new"] = False
-            logger.info(f"{server_info['id']}: updated new server successfully.")
+    return await asyncio.gather(*tasks)
 
-        if not server_info["uptime"]:
-            server_info["uptime"] = int(0)
 
-        if server_info["uptime"] != 0:
-            server_info["uptime"] += int(
-                (datetime.utcnow() - server_info["last_seen"]).total_seconds()
+async def perform_action(action, *args, **kwargs):
+    async def operation(xui, server_info):
+        return await getattr(xui, action)(*args, **kwargs)
+
+    results = []
+
+    for report in await fan_out(operation):
+        if not report["ok"]:
+            logger.error(
+                f"error performing {action} on {report['full_address']}: {report['error']}"
+            )
+        results.append(report["result"])
+
+    return results
+
+
+async def upsert_client(expire_time: datetime, user: User, enable: bool, limit_ip=5):
+    async def operation(xui, server_info):
+        try:
+            client = await xui.get_client(inbound_id=int(2), email=str(user.id))
+        except NotFound:
+            client = None
+
+        if client is not None:
+            result = await xui.update_client(
+                inbound_id=int(2),
+                email=str(user.id),
+                uuid=user.uuid,
+                enable=enable,
+                flow="xtls-rprx-vision",
+                limit_ip=limit_ip,
+                expire_time=int(expire_time.timestamp() * 1000),
+                total_gb=int(0),
+                telegram_id="",
+                subscription_id="",
+                client_id=client["id"],
             )
         else:
-            server_info["uptime"] = int(timedelta(seconds=1).total_seconds())
+            result = await xui.add_client(
+                inbound_id=int(2),
+                email=str(user.id),
+                uuid=user.uuid,
+                enable=enable,
+                flow="xtls-rprx-vision",
+                limit_ip=limit_ip,
+                expire_time=int(expire_time.timestamp() * 1000),
+                total_gb=int(0),
+                telegram_id="",
+                subscription_id="",
+            )
 
+        # Снимок инбаунда устарел после изменения клиента
+        xui.invalidate(int(2))
+
+        return result
+
+    report = await fan_out(operation)
+
+    for server_report in report:
+        if not server_report["ok"]:
+            logger.error(
+                f"Error upserting client on {server_report['full_address']}: {server_report['error']}"
+            )
+
+    return report
+
+
+async def iter_desired_clients(
+    batch_size: int = None, limit_ip=5
+) -> AsyncIterator[Dict[str, dict]]:
+    # Клиенты, которые должны быть на панелях, пачками по мере чтения курсора
+    batch_size = batch_size or config.DB_BATCH_SIZE
+    batch = {}
+
+    async for user, sub in UserService.iter_subscribed_users(batch_size):
+        batch[str(user.id)] = client_settings(
+            email=str(user.id),
+            uuid=user.uuid,
+            enable=True,
+            flow="xtls-rprx-vision",
+            limit_ip=limit_ip,
+            expire_time=int(sub.datetime_end.timestamp() * 1000),
+        )
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = {}
+
+    if batch:
+        yield batch
+
+
+async def desired_clients(limit_ip=5) -> Dict[str, dict]:
+    # Все клиенты сразу: по одному на активную подписку
+    desired = {}
+
+    async for batch in iter_desired_clients(limit_ip=limit_ip):
+        desired.update(batch)
+
+    return desired
+
+
+def changed_clients(desired: Dict[str, dict], current: Dict[str, dict]):
+    """
+    Сравнивает клиентов из базы и с панели по (email, uuid, expiryTime, enable).
+
+    Возвращает (add, update): новых клиентов и пары (id на панели, настройки)
+    для обновления. Смотрит только клиентов из desired, поэтому пачка стоит
+    O(len(desired)); лишних клиентов считает stale_clients.
+    """
+    add = []
+    update = []
+
+    for email, client in desired.items():
+        existing = current.get(email)
+
+        if existing is None:
+            add.append(client)
+        elif (
+            existing["id"] != client["id"]
+            or int(existing.get("expiryTime", 0)) != int(client.get("expiryTime", 0))
+            or bool(existing.get("enable", True)) != bool(client.get("enable", True))
+        ):
+            update.append((existing["id"], client))
+
+    return add, update
+
+
+def stale_clients(desired: Iterable[str], current: Dict[str, dict]):
+    # Отключаем только клиентов бота (email = id пользователя), ручные не трогаем
+    stale = {
+        email
+        for email, client in current.items()
+        if email.isdigit() and client.get("enable", True)
+    }.difference(desired)
+
+    return [
+        (current[email]["id"], {**current[email], "enable": False}) for email in stale
+    ]
+
+
+async def reconcile_server(
+    xui,
+    server_info,
+    inbound_id: int = 2,
+    desired: Dict[str, dict] = None,
+    dry_run: bool = False,
+    snapshot=None,
+) -> dict:
+    """
+    Приводит клиентов одной панели к активным подпискам из базы.
+
+    Список клиентов панели читается один раз. Если desired не передан,
+    подписки читаются из базы пачками и каждая пачка применяется сразу, не
+    дожидаясь остальных. Изменения отправляются пачками по XUI_RECONCILE_BATCH
+    с ограничением XUI_RECONCILE_RATE операций в секунду. С dry_run только
+    считает расхождения.
+
+    Снимок панели должен быть старше desired: иначе клиент, добавленный
+    outbox после чтения подписок, будет отключен или откачен. Вызывающий
+    код, который передает desired, передает и снятый до него snapshot.
+    """
+    started = time.monotonic()
+
+    if snapshot is None:
+        snapshot = await xui.get_snapshot(inbound_id, max_age=0)
+
+    report = {
+        "server": server_info["id"],
+        "clients": len(snapshot.clients),
+        "missing": 0,
+        "outdated": 0,
+        "stale": 0,
+        "added": 0,
+        "updated": 0,
+        "disabled": 0,
+        "failed": 0,
+        "elapsed": 0.0,
+        "throughput": 0.0,
+    }
+
+    batch_size = config.XUI_RECONCILE_BATCH
+    done = 0
+
+    async def apply(batch, counter, operation):
+        nonlocal done
+
+        batch_started = time.monotonic()
+
+        try:
+            await operation(batch)
+            report[counter] += len(batch)
+        except Exception as e:
+            logger.error(f"{server_info['id']}: reconcile batch failed: {e}")
+            report["failed"] += len(batch)
+
+        done += len(batch)
+        elapsed = time.monotonic() - started
         logger.info(
-            f"{server_info['id']}: uptime = {timedelta(seconds=server_info['uptime'])}"
+            f"{server_info['id']}: reconciled {done} clients "
+            f"({done / elapsed if elapsed else 0:.1f} ops/s)"
         )
-        server_info["last_seen"] = datetime.utcnow()
-        await ServerService.update(server_info)
 
-        return xui, True, server_info
-    except (BadLogin, Exception) as e:
-        logger.error(f"{server_info['full_address']}: failed to log in to {e}")
+        # Не даем пачкам превысить XUI_RECONCILE_RATE операций в секунду
+        await asyncio.sleep(
+            max(0.0, len(batch) / config.XUI_RECONCILE_RATE - (time.monotonic() - batch_started))
+        )
 
-        server_info["uptime"] = int(0)
-        await ServerService.update(server_info)
+    def check(result):
+        # Отклоненная пачка должна попасть в failed, иначе new сбросится
+        if not result or not result.get("success"):
+            raise PanelError((result or {}).get("msg"))
+
+    async def add_batch(batch):
+        check(await xui.add_clients(inbound_id, batch))
+
+    async def update_one(client_id, client):
+        async with xui.semaphore:
+            result = await xui.update_client(
+                inbound_id=inbound_id,
+                email=client["email"],
+                uuid=client["id"],
+                enable=client.get("enable", True),
+                flow=client.get("flow", ""),
+                limit_ip=client.get("limitIp", 0),
+                total_gb=client.get("totalGB", 0),
+                expire_time=client.get("expiryTime", 0),
+                telegram_id=client.get("tgId", ""),
+                subscription_id=client.get("subId", ""),
+                client_id=client_id,
+            )
 
-        return xui, False, server_info
+        check(result)
 
+    async def update_batch(batch):
+        results = await asyncio.gather(
+            *[update_one(client_id, client) for client_id, client in batch],
+            return_exceptions=True,
+        )
 
-async def login_all():
-    logger.info(f"start...")
+        # Остальные обновления пачки доходят до конца, ошибка — одна на пачку
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
 
-    global SERVERS
-    global XUI_INSTANCES
+    async def batches():
+        if desired is not None:
+            yield desired
+            return
 
-    SERVERS = await ServerService.get_all()
+        async for batch in iter_desired_clients():
+            yield batch
 
-    tasks = [login_to_server(server) for server in SERVERS]
-    XUI_INSTANCES = await asyncio.gather(*tasks)
+    seen = set()
 
-    LAST_UPDATE = datetime.utcnow()
+    async for batch in batches():
+        add, update = changed_clients(batch, snapshot.clients)
+        seen.update(batch)
 
-    return XUI_INSTANCES
+        report["missing"] += len(add)
+        report["outdated"] += len(update)
 
+        if dry_run:
+            continue
 
-async def perform_action(action, *args, **kwargs):
-    results = []
+        for i in range(0, len(add), batch_size):
+            await apply(add[i : i + batch_size], "added", add_batch)
 
-    for xui, is_logged_in, serverinfo in XUI_INSTANCES:
-        if not is_logged_in:
-            continue  # Пропускаем серверы, к которым не удалось подключиться
-        try:
-            result = await asyncio.to_thread(getattr(xui, action), *args, **kwargs)
-            results.append(result)
-        except Exception as e:
-            logger.error(f"error performing {action} on {xui.full_address}: {e}")
-            results.append(None)
+        for i in range(0, len(update), batch_size):
+            await apply(update[i : i + batch_size], "updated", update_batch)
 
-    return results
+    # Лишних клиентов видно только после того, как прочитаны все подписки
+    disable = stale_clients(seen, snapshot.clients)
+    report["stale"] = len(disable)
 
+    logger.info(
+        f"{server_info['id']}: reconcile {report['missing']} to add, "
+        f"{report['outdated']} to update, {report['stale']} to disable"
+    )
 
-async def upsert_client(expire_time: datetime, user: User, enable: bool, limit_ip=5):
-    for xui, is_logged_in, server_info in XUI_INSTANCES:
-        if not is_logged_in:
-            continue
-        try:
+    if not dry_run:
+        for i in range(0, len(disable), batch_size):
+            await apply(disable[i : i + batch_size], "disabled", update_batch)
+
+        if done:
+            xui.invalidate(inbound_id)
+
+    report["elapsed"] = time.monotonic() - started
+    report["throughput"] = done / report["elapsed"] if report["elapsed"] else 0.0
+
+    logger.info(f"{server_info['id']}: reconcile finished: {report}")
+
+    return report
+
+
+async def reconcile_all(dry_run: bool = False) -> List[dict]:
+    """
+    Проверяет расхождения между подписками в базе и клиентами всех панелей.
+
+    Сначала снимаются клиенты всех панелей, затем один раз читаются
+    подписки, так что покупки во время проверки не откатываются. Панели
+    обрабатываются не более чем по XUI_RECONCILE_CONCURRENCY одновременно.
+    """
+    semaphore = asyncio.Semaphore(config.XUI_RECONCILE_CONCURRENCY)
+    states = registry.REGISTRY.online
+
+    async def take_snapshot(state):
+        async with semaphore:
             try:
-                client = await asyncio.to_thread(
-                    xui.get_client, inbound_id=int(2), email=str(user.id)
-                )
-            except NotFound:
-                client = None
-            if client is not None:
-                await asyncio.to_thread(
-                    xui.update_client,
-                    inbound_id=int(2),
-                    email=str(user.id),
-                    uuid=user.uuid,
-                    enable=enable,
-                    flow="xtls-rprx-vision",
-                    limit_ip=limit_ip,
-                    expire_time=int(expire_time.timestamp() * 1000),
-                    total_gb=int(0),
-                    telegram_id="",
-                    subscription_id="",
-                )
+                return await state.xui.get_snapshot(2, max_age=0)
+            except Exception as e:
+                logger.error(f"{state.id}: drift check failed: {e}")
+                return e
+
+    snapshots = await asyncio.gather(*[take_snapshot(state) for state in states])
+    desired = await desired_clients()
 
-            else:
-                await asyncio.to_thread(
-                    xui.add_client,
-                    inbound_id=int(2),
-                    email=str(user.id),
-                    uuid=user.uuid,
-                    enable=enable,
-                    flow="xtls-rprx-vision",
-                    limit_ip=int(5),
-                    expire_time=int(expire_time.timestamp() * 1000),
-                    total_gb=int(0),
-                    telegram_id="",
-                    subscription_id="",
+    async def run(state, snapshot):
+        if isinstance(snapshot, Exception):
+            return {"server": state.id, "error": str(snapshot)}
+
+        async with semaphore:
+            try:
+                return await reconcile_server(
+                    state.xui,
+                    state.info,
+                    desired=desired,
+                    dry_run=dry_run,
+                    snapshot=snapshot,
                 )
-        except Exception as e:
-            logger.error(
-                f"Error upserting client on {server_info['full_address']}: {e}"
-            )
+            except Exception as e:
+                logger.error(f"{state.id}: drift check failed: {e}")
+                return {"server": state.id, "error": str(e)}
+
+    return await asyncio.gather(
+        *[run(state, snapshot) for state, snapshot in zip(states, snapshots)]
+    )
 
 
 async def serverconfigs_by_user(inbound_id, email):
-    results = []
+    async def operation(xui, server_info):
+        return await get_client_config(xui, inbound_id, email, server_info)
 
-    for xui, is_logged_in, server_info in XUI_INSTANCES:
-        if not is_logged_in:
-            continue
-        try:
-            conf = await get_client_config(xui, inbound_id, email, server_info)
-            results.append([server_info, conf])
-        except:
-            continue
+    return [
+        [report["server_info"], report["result"]]
+        for report in await fan_out(operation)
+        if report["ok"]
+    ]
 
-    return results
 
+async def serverconfig_by_user(inbound_id, email, server_id):
+    """
+    Ссылка пользователя для сервера с сохранением последней рабочей версии.
+
+    Ссылка пересобирается только при смене отпечатка настроек инбаунда
+    или UUID клиента; если панель медленная или недоступна, отдается
+    последняя сохраненная ссылка.
+    """
+    link = await LinkService.get(int(email), server_id)
+    state = registry.REGISTRY.get(server_id)
+
+    if state is None or not state.is_logged_in:
+        return link["link"] if link else None
 
-async def serverconfig_by_user(inbound_id, email, server_info):
     try:
-        xui, is_logged_in, server_info = next(
-            filter(lambda x: x[2] == server_info, XUI_INSTANCES)
+        snapshot = await asyncio.wait_for(
+            state.xui.get_snapshot(int(inbound_id)), timeout=config.XUI_LINK_DEADLINE
+        )
+        client = snapshot.clients.get(str(email))
+
+        if client is None:
+            return link["link"] if link else None
+
+        if (
+            link
+            and link["fingerprint"] == snapshot.fingerprint
+            and link["uuid"] == client.get("id")
+            and link["full_address"] == state.info["full_address"]
+        ):
+            return link["link"]
+
+        result = client_link(snapshot, client, state.info)
+
+        await LinkService.upsert(
+            {
+                "user_id": int(email),
+                "server_id": server_id,
+                "uuid": client.get("id"),
+                "full_address": state.info["full_address"],
+                "fingerprint": snapshot.fingerprint,
+                "link": result,
+            }
         )
-        if not is_logged_in:
-            return None
 
-        return await get_client_config(xui, inbound_id, email, server_info)
+        return result
+    except asyncio.TimeoutError:
+        state.xui.breaker.record(False)
+        logger.error(f"{server_id}: panel is too slow, serving last known link")
+
+        return link["link"] if link else None
     except Exception as e:
-        logger.error(f"error retrieving client config: {e}")
+        logger.error(f"error retrieving client config, serving last known link: {e}")
+
+        return link["link"] if link else None
+
+
+def client_link(snapshot, client: dict, srv_info: dict) -> str:
+    stream = snapshot.stream
+
+    link_config = {
+        "ps": srv_info["id"],
+        "add": urlparse(srv_info["full_address"]).hostname,
+        "port": snapshot.port,
+        "id": client.get("id", ""),
+    }
+
+    data = {
+        "security": stream["security"],
+        "type": stream["type"],
+        "sni": stream["sni"],
+        "spx": stream["spx"],
+        "pbk": stream["pbk"],
+        "sid": stream["sid"],
+        "flow": client.get("flow", ""),
+        "fp": stream["fp"],
+    }
+
+    return config_generator("vless", link_config, data)
 
 
 # Функция для извлечения конфигурации клиента по email
 async def get_client_config(xui_instance, inbound_id, email, srv_info):
     try:
-        inbounds = await asyncio.to_thread(xui_instance.get_inbounds)
-
-        for inbound in inbounds.get("obj", []):
-            if inbound["id"] == int(inbound_id):
-                settings = json.loads(inbound.get("settings", "{}"))
-                settings["stream"] = json.loads(inbound.get("streamSettings", "{}"))
-                settings["reality"] = settings["stream"].get("realitySettings", "{}")
-                settings["reality"]["connection"] = settings["reality"].get(
-                    "settings", "{}"
-                )
+        # Снимок инбаунда берется из кэша панели, сеть нужна только после TTL
+        snapshot = await xui_instance.get_snapshot(int(inbound_id))
+        client = snapshot.clients.get(str(email))
+
+        if client is None:
+            return None
 
-                for client in settings.get("clients", []):
-                    if client["email"] == str(email):
-                        config = {
-                            "ps": srv_info["id"],
-                            "add": urlparse(srv_info["full_address"]).hostname,
-                            "port": inbound["port"],
-                            "id": client.get("id", ""),
-                        }
-
-                        data = {
-                            "security": settings["stream"].get("security", ""),
-                            "type": settings["stream"].get("network", ""),
-                            "sni": settings["reality"].get("serverNames", [])[0],
-                            "spx": "/",
-                            "pbk": settings["reality"]["connection"].get(
-                                "publicKey", ""
-                            ),
-                            "sid": settings["reality"].get("shortIds", [])[0],
-                            "flow": client.get("flow", ""),
-                            "fp": settings["reality"]["connection"].get(
-                                "fingerprint", ""
-                            ),
-                        }
-
-                        return config_generator("vless", config, data)
+        return client_link(snapshot, client, srv_info)
 
     except Exception as e:
         logger.error(f"error retrieving client config: {e}")
 
     return None
-
-
-async def get_updown_stats(xui, inbound: int = 1):
-    data = await asyncio.to_thread(xui.get_inbounds)
-
-    up = down = 0
-
-    if data["success"] and len(data["obj"]) > 1:
-        obj = data["obj"][1]  # Get the second inbound
-        up = obj["up"] / (1024**2)  # Convert to MB
-        down = obj["down"] / (1024**2)  # Convert to MB
-
-    return up, down
@@ -0,0 +1,103 @@
+import time
+import asyncio
+
+from typing import List, Optional
+
+import config
+import registry
+
+from database import OutboxService, UserService
+from logger import logger
+
+WORKERS: List[asyncio.Task] = []
+
+# Когда воркеры последний раз возвращали брошенные записи в очередь
+RELEASED_AT: Optional[float] = None
+
+
+async def process(item: dict) -> None:
+    from network import upsert_client
+
+    user = await UserService.get(item["user_id"])
+
+    if user is None:
+        logger.error(f"outbox: user {item['user_id']} not found, dropping mutation")
+        await OutboxService.complete(item)
+        return
+
+    report = await upsert_client(item["expire_time"], user, item["enable"])
+    errors = [
+        f"{server_report['server']}: {server_report['error']}"
+        for server_report in report
+        if not server_report["ok"]
+    ]
+
+    # Серверы с открытым предохранителем fan_out пропускает — это временный
+    # отказ, мутация ждет их с backoff. Отключенные серверы догонит сверка
+    reached = {server_report["server"] for server_report in report}
+    errors += [
+        f"{state.id}: circuit is open"
+        for state in registry.REGISTRY.online
+        if state.id not in reached
+    ]
+
+    if errors:
+        await OutboxService.retry(item, "; ".join(errors))
+    else:
+        await OutboxService.complete(item)
+
+
+async def release_stale() -> None:
+    global RELEASED_AT
+
+    # Запись, взятая упавшим процессом, иначе навсегда заблокирует пользователя:
+    # claim пропускает пользователей с записями в обработке
+    if (
+        RELEASED_AT is not None
+        and time.monotonic() - RELEASED_AT < config.OUTBOX_STALE_TIMEOUT / 2
+    ):
+        return
+
+    RELEASED_AT = time.monotonic()
+    released = await OutboxService.release_stale()
+
+    if released:
+        logger.info(f"released {released} stale outbox mutations")
+
+
+async def worker(number: int) -> None:
+    while True:
+        try:
+            await release_stale()
+
+            item = await OutboxService.claim()
+
+            if item is None:
+                try:
+                    await asyncio.wait_for(
+                        OutboxService.WAKEUP.wait(), timeout=config.OUTBOX_POLL_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                OutboxService.WAKEUP.clear()
+                continue
+
+            try:
+                await process(item)
+            except Exception as e:
+                logger.error(f"outbox: mutation for user {item['user_id']} failed: {e}")
+                await OutboxService.retry(item, str(e))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"outbox worker #{number}: {e}")
+            await asyncio.sleep(config.OUTBOX_POLL_INTERVAL)
+
+
+async def start() -> None:
+    await release_stale()
+
+    for number in range(config.OUTBOX_WORKERS):
+        WORKERS.append(asyncio.create_task(worker(number)))
+
+    logger.info(f"started {config.OUTBOX_WORKERS} outbox workers")
@@ -0,0 +1,386 @@
+import json
+import time
+import hashlib
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from pyxui.errors import BadLogin, NotFound
+
+import config
+
+from breaker import CircuitBreaker, CircuitOpen
+
+API_PATHS = {"alireza": "xui/API", "sanaei": "panel/api"}
+
+
+class PanelError(Exception):
+    """Панель ответила 200, но отклонила изменение ({"success": false})."""
+
+    def __init__(self, message: str = None):
+        super().__init__(message or "panel rejected the request")
+
+
+class InboundSnapshot:
+    """
+    Разобранное состояние инбаунда на момент запроса get_inbounds.
+
+    settings/streamSettings разбираются один раз; клиенты проиндексированы
+    по email, параметры reality вынесены в stream, чтобы сборка ссылки
+    не требовала ни сети, ни json.loads.
+    """
+
+    def __init__(self, inbound: dict, fetched_at: float = None):
+        settings = json.loads(inbound.get("settings") or "{}")
+        stream = json.loads(inbound.get("streamSettings") or "{}")
+        reality = stream.get("realitySettings") or {}
+        connection = reality.get("settings") or {}
+
+        self.id = inbound["id"]
+        self.port = inbound.get("port")
+        self.up = inbound.get("up", 0)
+        self.down = inbound.get("down", 0)
+        # Момент отправки запроса: данные не старше него
+        self.fetched_at = time.monotonic() if fetched_at is None else fetched_at
+
+        self.stream = {
+            "security": stream.get("security", ""),
+            "type": stream.get("network", ""),
+            "sni": (reality.get("serverNames") or [""])[0],
+            "spx": "/",
+            "pbk": connection.get("publicKey", ""),
+            "sid": (reality.get("shortIds") or [""])[0],
+            "fp": connection.get("fingerprint", ""),
+        }
+
+        # Меняется только вместе с параметрами подключения, а не со списком клиентов
+        self.fingerprint = hashlib.sha1(
+            json.dumps([self.port, self.stream], sort_keys=True).encode()
+        ).hexdigest()
+
+        self.clients = {
+            str(client["email"]): client for client in settings.get("clients", [])
+        }
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+class Panel:
+    """
+    Асинхронный клиент панели 3x-ui.
+
+    Повторяет методы pyxui.XUI, которые использует network.py, но работает
+    поверх одной долгоживущей aiohttp-сессии на сервер: соединения
+    переиспользуются (keep-alive), cookie авторизации хранятся в cookie jar.
+    """
+
+    def __init__(self, full_address: str, panel: str, https: bool = False):
+        self.full_address = full_address.rstrip("/")
+        self.panel = panel
+        self.https = https
+        self.api_path = API_PATHS.get(panel)
+        self.session_string: Optional[str] = None
+        self.semaphore = asyncio.Semaphore(config.XUI_SERVER_CONCURRENCY)
+        self.breaker = CircuitBreaker()
+        self.snapshots: Dict[int, InboundSnapshot] = {}
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._snapshot_lock = asyncio.Lock()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Сессия создается лениво, внутри работающего event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.XUI_CONNECTIONS_LIMIT,
+                keepalive_timeout=config.XUI_KEEPALIVE_TIMEOUT,
+                ssl=None if self.https else False,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=config.XUI_REQUEST_TIMEOUT,
+                    connect=config.XUI_CONNECT_TIMEOUT,
+                ),
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @asynccontextmanager
+    async def observe(self):
+        # Сетевые ошибки, таймауты и 5xx открывают предохранитель,
+        # любой осмысленный ответ панели (в том числе 404) считается успехом
+        started = time.monotonic()
+
+        try:
+            yield
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.breaker.record(False)
+            raise
+        except Exception:
+            self.breaker.record(True, time.monotonic() - started)
+            raise
+
+        self.breaker.record(True, time.monotonic() - started)
+
+    async def request(self, path: str, method: str, params: dict = None) -> dict:
+        if path == "login":
+            url = f"{self.full_address}/login"
+        else:
+            url = f"{self.full_address}/{self.api_path}/inbounds/{path}"
+
+        if not self.breaker.allow():
+            raise CircuitOpen()
+
+        async with self.observe():
+            async with self.session.request(method, url, data=params) as response:
+                if response.status >= 500:
+                    response.raise_for_status()
+
+                if response.status == 404 or response.content_type != "application/json":
+                    raise NotFound()
+
+                data = await response.json()
+
+        # addClient/updateClient отклоняются с HTTP 200 (например, "Duplicate email")
+        if method == "POST" and data.get("success") is False:
+            raise PanelError(data.get("msg"))
+
+        return data
+
+    async def login(self, username: str, password: str) -> bool:
+        session = self.session
+        session.cookie_jar.clear()
+
+        # Логин и ping не блокируются предохранителем: это пробные запросы
+        async with self.observe():
+            async with session.post(
+                f"{self.full_address}/login",
+                data={"username": username, "password": password},
+            ) as response:
+                if response.status != 200 or not response.cookies:
+                    raise BadLogin()
+
+                # pyxui хранит cookie "session", новые версии 3x-ui отдают "3x-ui"
+                cookie = response.cookies.get("session") or next(
+                    iter(response.cookies.values())
+                )
+                self.session_string = cookie.value
+
+        return True
+
+    async def ping(self) -> dict:
+        """
+        Дешевая проверка сессии: статус сервера вместо списка инбаундов.
+
+        BadLogin означает, что сессия истекла и нужен повторный логин.
+        """
+        async with self.observe():
+            async with self.session.post(
+                f"{self.full_address}/server/status", allow_redirects=False
+            ) as response:
+                # Без авторизации панель отвечает 401 или редиректом на логин
+                if response.status in (401, 403) or 300 <= response.status < 400:
+                    raise BadLogin()
+
+                if response.status >= 500:
+                    response.raise_for_status()
+
+                if response.status == 404 or response.content_type != "application/json":
+                    raise NotFound()
+
+                data = await response.json()
+
+        if not data.get("success"):
+            raise BadLogin()
+
+        return data
+
+    async def get_inbounds(self) -> dict:
+        path = "" if self.panel == "alireza" else "list"
+        return await self.request(path=path, method="GET")
+
+    async def get_inbound(self, inbound_id: int) -> dict:
+        return await self.request(path=f"get/{inbound_id}", method="GET")
+
+    async def refresh_snapshots(self) -> dict:
+        started = time.monotonic()
+        inbounds = await self.get_inbounds()
+
+        self.snapshots = {
+            inbound["id"]: InboundSnapshot(inbound, started) for inbound in inbounds["obj"]
+        }
+
+        return inbounds
+
+    async def get_snapshot(self, inbound_id: int, max_age: float = None) -> InboundSnapshot:
+        if max_age is None:
+            max_age = config.XUI_SNAPSHOT_TTL
+
+        snapshot = self.snapshots.get(inbound_id)
+
+        if snapshot is None or snapshot.age() > max_age:
+            waiting_since = time.monotonic()
+
+            # Одновременные запросы ждут одну загрузку вместо нескольких: снимок,
+            # запрошенный после начала ожидания, достаточно свежий даже для max_age=0
+            async with self._snapshot_lock:
+                snapshot = self.snapshots.get(inbound_id)
+
+                if snapshot is None or (
+                    snapshot.age() > max_age and snapshot.fetched_at < waiting_since
+                ):
+                    await self.refresh_snapshots()
+                    snapshot = self.snapshots.get(inbound_id)
+
+        if snapshot is None:
+            raise NotFound()
+
+        return snapshot
+
+    def invalidate(self, inbound_id: int = None) -> None:
+        if inbound_id is None:
+            self.snapshots = {}
+        else:
+            self.snapshots.pop(inbound_id, None)
+
+    async def get_client(
+        self, inbound_id: int, email: str = False, uuid: str = False
+    ) -> dict:
+        if not email and not uuid:
+            raise ValueError()
+
+        # Клиенты нужны свежие, заодно обновляется кэш для get_client_config
+        snapshot = await self.get_snapshot(inbound_id, max_age=0)
+
+        if email and str(email) in snapshot.clients:
+            return snapshot.clients[str(email)]
+
+        for client in snapshot.clients.values():
+            if client["id"] == uuid:
+                return client
+
+        raise NotFound()
+
+    async def add_client(
+        self,
+        inbound_id: int,
+        email: str,
+        uuid: str,
+        enable: bool = True,
+        flow: str = "",
+        limit_ip: int = 0,
+        total_gb: int = 0,
+        expire_time: int = 0,
+        telegram_id: str = "",
+        subscription_id: str = "",
+    ) -> dict:
+        settings = {
+            "clients": [
+                client_settings(
+                    email,
+                    uuid,
+                    enable,
+                    flow,
+                    limit_ip,
+                    total_gb,
+                    expire_time,
+                    telegram_id,
+                    subscription_id,
+                )
+            ],
+            "decryption": "none",
+            "fallbacks": [],
+        }
+
+        return await self.request(
+            path="addClient",
+            method="POST",
+            params={"id": inbound_id, "settings": json.dumps(settings)},
+        )
+
+    async def add_clients(self, inbound_id: int, clients: List[dict]) -> dict:
+        # addClient принимает сразу несколько клиентов — один запрос на пачку
+        settings = {"clients": clients, "decryption": "none", "fallbacks": []}
+
+        return await self.request(
+            path="addClient",
+            method="POST",
+            params={"id": inbound_id, "settings": json.dumps(settings)},
+        )
+
+    async def update_client(
+        self,
+        inbound_id: int,
+        email: str,
+        uuid: str,
+        enable: bool,
+        flow: str,
+        limit_ip: int,
+        total_gb: int,
+        expire_time: int,
+        telegram_id: str,
+        subscription_id: str,
+        client_id: str = None,
+    ) -> dict:
+        # client_id можно передать, если клиент уже получен, — экономит get_inbounds
+        if client_id is None:
+            client = await self.get_client(inbound_id=inbound_id, email=email, uuid=uuid)
+            client_id = client["id"]
+
+        settings = {
+            "clients": [
+                client_settings(
+                    email,
+                    uuid,
+                    enable,
+                    flow,
+                    limit_ip,
+                    total_gb,
+                    expire_time,
+                    telegram_id,
+                    subscription_id,
+                )
+            ],
+            "decryption": "none",
+            "fallbacks": [],
+        }
+
+        return await self.request(
+            path=f"updateClient/{client_id}",
+            method="POST",
+            params={"id": inbound_id, "settings": json.dumps(settings)},
+        )
+
+
+def client_settings(
+    email: str,
+    uuid: str,
+    enable: bool = True,
+    flow: str = "",
+    limit_ip: int = 0,
+    total_gb: int = 0,
+    expire_time: int = 0,
+    telegram_id: str = "",
+    subscription_id: str = "",
+) -> dict:
+    return {
+        "id": uuid,
+        "email": email,
+        "enable": enable,
+        "flow": flow,
+        "limitIp": limit_ip,
+        "totalGB": total_gb,
+        "expiryTime": expire_time,
+        "tgId": telegram_id,
+        "subId": subscription_id,
+    }
@@ -0,0 +1,72 @@
+from types import MappingProxyType
+from typing import List, Mapping, Optional
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import db
+from logger import logger
+
+
+class Catalog:
+    """
+    Неизменяемый снимок тарифов из db.pricing.
+
+    Тарифы доступны по id за O(1), клавиатура покупки и текст реферальных
+    бонусов собираются один раз при загрузке. При изменении цен снимок
+    не правится, а заменяется новым целиком.
+    """
+
+    __slots__ = ("plans", "by_id", "keyboard", "referral_text")
+
+    def __init__(self, plans: List[dict] = ()):
+        self.plans = tuple(MappingProxyType(dict(plan)) for plan in plans)
+        self.by_id: Mapping[str, Mapping] = MappingProxyType(
+            {plan["id"]: plan for plan in self.plans}
+        )
+
+        self.keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [
+                    InlineKeyboardButton(
+                        text=f"📅 Купить {plan['name_ru']} – ${plan['price']}",
+                        callback_data=f"buy_{plan['id']}",
+                    )
+                ]
+                for plan in self.plans
+            ]
+        )
+
+        self.referral_text = "".join(
+            f"• за <b>{plan['name_ru']}</b> – <code>{plan['referral_bonus']}</code> бонусных дней!\n"
+            for plan in self.plans
+        )
+
+    def get(self, plan_id: str) -> Optional[Mapping]:
+        return self.by_id.get(plan_id)
+
+    def __iter__(self):
+        return iter(self.plans)
+
+    def __len__(self) -> int:
+        return len(self.plans)
+
+
+# Заменяется одним присваиванием, обработчики всегда видят целый снимок
+CATALOG = Catalog()
+
+
+async def reload() -> bool:
+    global CATALOG
+
+    try:
+        catalog = Catalog(await db.pricing.find().to_list(None))
+    except Exception as e:
+        logger.error("failed to fetch prices: " + str(e))
+        return False
+
+    # При опросе цены обычно не меняются, в лог попадают только изменения
+    if catalog.plans != CATALOG.plans:
+        logger.info(f"fetched {len(catalog)} prices")
+
+    CATALOG = catalog
+    return True
@@ -0,0 +1,183 @@
+import asyncio
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from pyxui.errors import BadLogin
+
+from database import ServerService
+from logger import logger
+from panel import Panel
+
+# Клиенты панелей живут между проверками, чтобы не терять keep-alive и cookie
+PANELS = {}
+
+
+class ServerState:
+    __slots__ = ("xui", "is_logged_in", "info")
+
+    def __init__(self, xui: Panel, is_logged_in: bool, info: dict):
+        self.xui = xui
+        self.is_logged_in = is_logged_in
+        self.info = info
+
+    @property
+    def id(self) -> str:
+        return self.info["id"]
+
+
+class ServerRegistry:
+    """
+    Неизменяемый снимок состояния серверов с доступом по id за O(1).
+
+    online — заранее посчитанный список доступных серверов в порядке из базы;
+    available() дополнительно отсеивает серверы с открытым предохранителем.
+    """
+
+    __slots__ = ("states", "online")
+
+    def __init__(self, states: List[ServerState] = ()):
+        self.states: Dict[str, ServerState] = {state.id: state for state in states}
+        self.online: List[ServerState] = [
+            state for state in self.states.values() if state.is_logged_in
+        ]
+
+    def get(self, server_id: str) -> Optional[ServerState]:
+        return self.states.get(server_id)
+
+    def available(self) -> List[ServerState]:
+        # Доступные серверы без открытого предохранителя
+        return [state for state in self.online if not state.xui.breaker.is_open]
+
+    def __iter__(self):
+        return iter(self.states.values())
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+
+# Заменяется целиком одним присваиванием, поэтому обработчики,
+# которые по нему итерируются, не видят промежуточных состояний
+REGISTRY = ServerRegistry()
+
+LAST_UPDATE = None
+
+_refresh_lock = asyncio.Lock()
+
+
+async def get_panel(server_info) -> Panel:
+    xui = PANELS.get(server_info["id"])
+
+    if xui is not None and (
+        xui.full_address != server_info["full_address"].rstrip("/")
+        or xui.panel != server_info["panel"]
+    ):
+        await xui.close()
+        xui = None
+
+    if xui is None:
+        xui = Panel(
+            full_address=server_info["full_address"],
+            panel=server_info["panel"],
+            https=False,
+        )
+        PANELS[server_info["id"]] = xui
+
+    return xui
+
+
+async def check_server(server_info, force_login: bool = False) -> ServerState:
+    """
+    Проверяет сервер и возвращает его новое состояние.
+
+    Живая сессия проверяется дешевым запросом статуса; повторный логин
+    выполняется только при ошибке авторизации, если сервер был недоступен
+    при прошлой проверке или если он передан с force_login.
+    """
+    xui = await get_panel(server_info)
+    previous = REGISTRY.get(server_info["id"])
+    was_online = previous is not None and previous.is_logged_in
+
+    try:
+        logged_in = False
+
+        if force_login or not was_online or xui.session_string is None:
+            await xui.login(server_info["username"], server_info["password"])
+            logged_in = True
+        else:
+            try:
+                await xui.ping()
+            except BadLogin:
+                logger.info(f"{server_info['id']}: session expired, logging in again")
+                await xui.login(server_info["username"], server_info["password"])
+                logged_in = True
+
+        if logged_in:
+            logger.info(f"{server_info['id']}: successful login")
+
+        if server_info["new"]:
+            logger.info(
+                f"Detected new server ({server_info['id']}), updating clients..."
+            )
+
+            from network import reconcile_server
+
+            report = await reconcile_server(xui, server_info)
+
+            # Если часть клиентов не применилась, повторим при следующей проверке
+            if not report["failed"]:
+                server_info["new"] = False
+                logger.info(f"{server_info['id']}: updated new server successfully.")
+            else:
+                logger.error(
+                    f"{server_info['id']}: {report['failed']} clients failed to reconcile"
+                )
+
+        if not server_info["uptime"]:
+            server_info["uptime"] = int(0)
+
+        if server_info["uptime"] != 0:
+            server_info["uptime"] += int(
+                (datetime.utcnow() - server_info["last_seen"]).total_seconds()
+            )
+        else:
+            server_info["uptime"] = int(timedelta(seconds=1).total_seconds())
+
+        logger.info(
+            f"{server_info['id']}: uptime = {timedelta(seconds=server_info['uptime'])}"
+        )
+        server_info["last_seen"] = datetime.utcnow()
+        await ServerService.update(server_info)
+
+        return ServerState(xui, True, server_info)
+    except Exception as e:
+        logger.error(f"{server_info['full_address']}: server check failed: {e}")
+
+        server_info["uptime"] = int(0)
+        await ServerService.update(server_info)
+
+        return ServerState(xui, False, server_info)
+
+
+async def refresh(force_login: bool = False) -> ServerRegistry:
+    global REGISTRY
+    global LAST_UPDATE
+
+    # Cron и /login могут запустить проверку одновременно
+    async with _refresh_lock:
+        servers = await ServerService.get_all()
+
+        # Закрываем сессии серверов, удаленных из базы
+        server_ids = {server["id"] for server in servers}
+        for server_id in list(PANELS):
+            if server_id not in server_ids:
+                await PANELS.pop(server_id).close()
+
+        states = await asyncio.gather(
+            *[check_server(server, force_login) for server in servers]
+        )
+
+        REGISTRY = ServerRegistry(states)
+        LAST_UPDATE = datetime.utcnow()
+
+        return REGISTRY
@@ -0,0 +1,56 @@
+import time
+import asyncio
+
+from typing import Optional
+
+import config
+
+from database import OutboxService, SubService, UserService
+from logger import logger
+
+
+class Dashboard:
+    __slots__ = ("users", "active_subs", "outbox", "user_cache", "taken_at")
+
+    def __init__(self, users: int, active_subs: int, outbox: dict, user_cache: dict):
+        self.users = users
+        self.active_subs = active_subs
+        self.outbox = outbox
+        self.user_cache = user_cache
+        self.taken_at = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.taken_at
+
+
+# Последний снимок; /status берет его, пока он моложе STATS_TTL
+DASHBOARD: Optional[Dashboard] = None
+_lock = asyncio.Lock()
+
+
+async def collect() -> Dashboard:
+    # Только дешевые запросы: оценка по метаданным и подсчеты по индексам
+    users, active_subs, outbox = await asyncio.gather(
+        UserService.estimated_count(),
+        SubService.count_active(),
+        OutboxService.metrics(),
+    )
+
+    return Dashboard(users, active_subs, outbox, UserService.CACHE.stats())
+
+
+async def dashboard(max_age: float = None) -> Dashboard:
+    global DASHBOARD
+
+    if max_age is None:
+        max_age = config.STATS_TTL
+
+    if DASHBOARD is None or DASHBOARD.age() > max_age:
+        # Одновременные /status ждут один сбор статистики
+        async with _lock:
+            if DASHBOARD is None or DASHBOARD.age() > max_age:
+                started = time.monotonic()
+                DASHBOARD = await collect()
+                logger.info(f"collected stats in {time.monotonic() - started:.3f}s")
+
+    return DASHBOARD
@@ -31,13 +31,19 @@ from database import (
 from logger import logger
 
 import config
+import breaker
 import network
+import registry
+import stats
+import traffic
 import database
 import payments
+import pricing
 import middlewares
 
 dp = Dispatcher()
 dp.message.middleware(middlewares.BanMiddleware())
+dp.callback_query.middleware(middlewares.BanMiddleware())
 
 
 def admin_required(func):
@@ -68,7 +74,6 @@ async def main():
     global bot
     bot = Bot(config.TELEGRAM_TOKEN, parse_mode=ParseMode.HTML)
 
-    await SubService.fetch_prices()
     await database.initialize_coupons()
 
     await dp.start_polling(bot)
@@ -112,15 +117,14 @@ async def start(message: types.Message):
     if not user:
         balance = 0
         if coupon:
-            coupon_data = await CouponService.get_valid(coupon, message.chat.id)
+            coupon_data = await CouponService.redeem(coupon, message.chat.id)
             if coupon_data:
                 balance = coupon_data["value"]
-                await CouponService.activate(coupon, message.chat.id)
 
                 logger.info(
                     f"user {message.chat.id} activated coupon {coupon} with value ${balance}"
                 )
-                bot.send_message(
+                await bot.send_message(
                     message.chat.id,
                     f"<b>Купон <code>{coupon}</code> успешно активирован!\n</b>💰 Ваш баланс пополнен на <b>${balance}</b>",
                 )
@@ -142,10 +146,9 @@ async def start(message: types.Message):
         )
     else:
         if coupon:
-            coupon_data = await CouponService.get_valid(coupon, user.id)
+            coupon_data = await CouponService.redeem(coupon, user.id)
             if coupon_data:
                 await Admin.add_balance(user, coupon_data["value"], notify=False)
-                await CouponService.activate(coupon, user.id)
 
                 logger.info(
                     f"user {user.id} activated coupon {coupon} with value ${coupon_data['value']}"
@@ -217,28 +220,15 @@ async def menu_subscription(message: types.Message):
 
     kb = []
 
-    for server in network.SERVERS:
-        # Сопоставляем сервер с экземпляром xui
-        xui_instance = next(
-            (
-                instance
-                for instance in network.XUI_INSTANCES
-                if instance[2]["id"] == server["id"]
-            ),
-            None,
-        )
-
-        # Если экземпляр xui найден и пользователь залогинен, добавляем сервер в меню
-        if (
-            xui_instance and xui_instance[1]
-        ):  # xui_instance[1] содержит значение is_logged_in
-            kb += [
-                [
-                    InlineKeyboardButton(
-                        text=server["name"], callback_data=f"connect_{server['id']}"
-                    )
-                ]
+    # В меню попадают только доступные серверы
+    for state in registry.REGISTRY.available():
+        kb += [
+            [
+                InlineKeyboardButton(
+                    text=state.info["name"], callback_data=f"connect_{state.id}"
+                )
             ]
+        ]
 
     await message.answer(
         f"🔐 <b>Активная подписка</b>\n"
@@ -263,47 +253,53 @@ async def action_connect(query: types.CallbackQuery):
         query.answer("<b>У вас нет активной подписки.</b>")
         return
 
-    for xui, is_logged_in, serverinfo in network.XUI_INSTANCES:
-        if not is_logged_in or serverinfo["id"] != server_id:
-            continue
+    state = registry.REGISTRY.get(server_id)
 
-        config = await network.serverconfig_by_user(2, user.id, serverinfo)
+    # Недоступный сервер не мешает: отдается последняя сохраненная ссылка
+    if state is not None:
+        serverinfo = state.info
+    else:
+        serverinfo = await ServerService.get_by_id(server_id) or {"name": server_id}
 
-        if not config:
-            bot.send_message(
-                query.from_user.id,
-                "<b>Ошибка при получении конфигурации сервера.</b>"
-                "\n\nОбратитесь к поддержке бота, чтобы решить эту проблему",
-            )
+    config = await network.serverconfig_by_user(2, user.id, server_id)
 
-        # Генерируем QR-код
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=5,
-            border=4,
+    if not config:
+        await bot.send_message(
+            query.from_user.id,
+            "<b>Ошибка при получении конфигурации сервера.</b>"
+            "\n\nОбратитесь к поддержке бота, чтобы решить эту проблему",
         )
-        qr.add_data(config)
-        qr.make(fit=True)
+        await bot.answer_callback_query(query.id)
+        return
 
-        img = qr.make_image(fill_color=(188, 221, 228), back_color="transparent")
+    # Генерируем QR-код
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=5,
+        border=4,
+    )
+    qr.add_data(config)
+    qr.make(fit=True)
 
-        with io.BytesIO() as output:
-            img.save(output)
-            output.seek(0)
+    img = qr.make_image(fill_color=(188, 221, 228), back_color="transparent")
 
-            file = types.BufferedInputFile(output.getvalue(), filename="qr.png")
+    with io.BytesIO() as output:
+        img.save(output)
+        output.seek(0)
 
-            # Отправляем сообщение с QR-кодом
-            await bot.send_message(
-                query.from_user.id,
-                text=f"Ваша ссылка для подключения к <b>{serverinfo['name']}</b>\n\n"
-                f"<code>{config}</code>\n\n",
-            )
-            # await bot.send_photo(query.from_user.id, photo=file, caption=f"Сканируйте QR-код для подключения к <b>{serverinfo['name']}</b>")
-            await bot.send_sticker(query.from_user.id, sticker=file)
+        file = types.BufferedInputFile(output.getvalue(), filename="qr.png")
 
-        await bot.answer_callback_query(query.id)
+        # Отправляем сообщение с QR-кодом
+        await bot.send_message(
+            query.from_user.id,
+            text=f"Ваша ссылка для подключения к <b>{serverinfo['name']}</b>\n\n"
+            f"<code>{config}</code>\n\n",
+        )
+        # await bot.send_photo(query.from_user.id, photo=file, caption=f"Сканируйте QR-код для подключения к <b>{serverinfo['name']}</b>")
+        await bot.send_sticker(query.from_user.id, sticker=file)
+
+    await bot.answer_callback_query(query.id)
 
 
 @dp.callback_query(lambda query: query.data == "menu_invite")
@@ -325,8 +321,7 @@ async def menu_invite(query: types.CallbackQuery):
         f"<code>{referral_link}</code>\n\n"
     )
     referral_description += "Если ваш реферал купит подписку, то вы получите:\n"
-    for sub in SubService.POOL:
-        referral_description += f"• за <b>{sub['name_ru']}</b> – <code>{sub['referral_bonus']}</code> бонусных дней!\n"
+    referral_description += pricing.CATALOG.referral_text
 
     await bot.send_message(query.from_user.id, referral_description)
     await bot.answer_callback_query(query.id)
@@ -385,21 +380,10 @@ async def menu_buy(argument):
         )
         return
 
-    kb = []
-
-    for sub in SubService.POOL:
-        kb += [
-            [
-                InlineKeyboardButton(
-                    text=f"📅 Купить {sub['name_ru']} – ${sub['price']}",
-                    callback_data=f"buy_{sub['id']}",
-                )
-            ]
-        ]
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=kb)
-
-    await message.answer("<b>Доступные подписки: </b>", reply_markup=keyboard)
+    # Клавиатура собрана заранее при загрузке тарифов
+    await message.answer(
+        "<b>Доступные подписки: </b>", reply_markup=pricing.CATALOG.keyboard
+    )
 
 
 @dp.callback_query(lambda query: query.data.startswith("menu_prolongate_"))
@@ -416,27 +400,35 @@ async def action_prolongate(query: types.CallbackQuery):
         return
 
     user_sub = await user.get_active_sub()
-    sub_data = None
 
     if not user_sub:
         await query.message.answer("<b>У вас нет активной подписки.</b>")
         return
 
-    for sub in SubService.POOL:
-        if sub["id"] == subscription:
-            sub_data = sub
-            break
+    sub_data = pricing.CATALOG.get(subscription)
 
     if not sub_data:
-        query.message.answer("<b>Подписка не найдена.</b>")
-
-    user.balance -= sub_data["price"]
-    user.total_spent += sub_data["price"]
+        await query.message.answer("<b>Подписка не найдена.</b>")
+        return
 
-    user_sub.datetime_end += timedelta(days=sub_data["duration"])
+    # Проверка баланса, списание и продление — атомарно, без гонки двойного клика
+    user_sub = await SubService.purchase(
+        user.id, sub_data["price"], sub_data["duration"], sub_data["name_ru"]
+    )
 
-    await SubService.upsert(user_sub)
-    await UserService.upsert(user)
+    if not user_sub:
+        kb = [
+            [
+                InlineKeyboardButton(
+                    text="💳 Пополнить баланс", callback_data="menu_deposit"
+                )
+            ]
+        ]
+        await query.message.answer(
+            "<b>Недостаточно средств на балансе.</b>",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
+        )
+        return
 
     if user.referral_id != 0:
         referrer = await UserService.get(user.referral_id)
@@ -471,12 +463,12 @@ async def action_buy_callback(query: types.CallbackQuery):
     await bot.answer_callback_query(query.id)
 
     subscription = "_".join(query.data.split("_")[1:])
-    sub_data = None
+    sub_data = pricing.CATALOG.get(subscription)
 
-    for sub in SubService.POOL:
-        if sub["id"] == subscription:
-            sub_data = sub
-            break
+    # Кнопка могла остаться от тарифа, удаленного после перезагрузки цен
+    if not sub_data:
+        await query.message.answer("<b>Подписка не найдена.</b>")
+        return
 
     user = await UserService.get(query.from_user.id)
 
@@ -545,12 +537,7 @@ async def action_confirm_buy(query: types.CallbackQuery):
     await bot.answer_callback_query(query.id)
 
     subscription = "_".join(query.data.split("_")[2:])
-    sub_data = None
-
-    for sub in SubService.POOL:
-        if sub["id"] == subscription:
-            sub_data = sub
-            break
+    sub_data = pricing.CATALOG.get(subscription)
 
     user = await UserService.get(query.from_user.id)
 
@@ -558,16 +545,36 @@ async def action_confirm_buy(query: types.CallbackQuery):
         await query.message.answer("<b>Пользователь не найден.</b>")
         return
 
-    user_sub = await user.get_active_sub()
-
     if not sub_data:
         await query.message.answer("<b>Подписка не найдена.</b>")
+        return
 
-    user.balance -= sub_data["price"]
-    user.total_spent += sub_data["price"]
-    await UserService.upsert(user)
+    # Проверка баланса, списание и подписка — атомарно, без гонки двойного клика
+    result_sub = await SubService.purchase(
+        user.id, sub_data["price"], sub_data["duration"], sub_data["name_ru"]
+    )
+
+    if not result_sub:
+        kb = [
+            [
+                InlineKeyboardButton(
+                    text="💳 Пополнить баланс", callback_data="menu_deposit"
+                )
+            ]
+        ]
+        await query.message.answer(
+            "<b>Недостаточно средств на балансе.</b>",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
+        )
+        return
 
-    result_sub = await Admin.add_subscription(user, sub_data)
+    logger.info(
+        f"user {user.id} has bought a subscription {sub_data['name_ru']} for ${sub_data['price']}."
+    )
+
+    await bot.send_message(
+        user.id, f"✅ Подписка <b>{sub_data['name_ru']}</b> успешно куплена\n"
+    )
 
     for admin in config.TELEGRAM_ADMINS:
         await bot.send_message(
@@ -613,11 +620,13 @@ async def menu_deposit(query: types.CallbackQuery):
         await query.message.answer("<b>Пользователь не найден.</b>")
         return
 
-    if not await user.get_wallets():
-        await WalletService.upsert_many(await payments.init_user_wallets(user.id))
-
     wallets = await user.get_wallets()
 
+    if not wallets:
+        wallets = await WalletService.upsert_many(
+            await payments.init_user_wallets(user.id)
+        )
+
     eth_address = next(
         (wallet["address"] for wallet in wallets if wallet["currency"] == "ETH"), None
     )
@@ -711,11 +720,19 @@ class Utils:
     async def render_status(message: types.Message):
         status_msg = f"<b>🔧 Статус серверов</b>\n\n"
 
-        for xui, is_logged_in, server_info in network.XUI_INSTANCES:
-            up, down = await network.get_updown_stats(xui)
+        for state in registry.REGISTRY:
+            is_logged_in, server_info = state.is_logged_in, state.info
+            # Трафик берется из замеров traffic.sample_all, панели не опрашиваются
+            up, down = (value / (1024**2) for value in traffic.latest(state.id))
+            up_rate, down_rate = (value / 1024 for value in traffic.rate(state.id))
             uptime = str(timedelta(seconds=server_info["uptime"]))
 
-            status_msg += "🟢 " if is_logged_in else "🔴 "
+            if not is_logged_in:
+                status_msg += "🔴 "
+            elif state.xui.breaker.state != breaker.CLOSED:
+                status_msg += "🟡 "
+            else:
+                status_msg += "🟢 "
             status_msg += "<b>" + server_info["name"] + "</b>\n"
             status_msg += "├ 🔗 <code>" + server_info["full_address"] + "</code>\n"
             status_msg += (
@@ -724,18 +741,62 @@ class Utils:
                 + "</code>\n"
             )
             status_msg += "├ 🕑 Uptime <code>" + uptime + "</code>\n"
-            status_msg += f"└ ⬆️ <code>{round(up)} Mbytes</code> ⬇️ <code>{round(down)} Mbytes</code>\n\n"
+            status_msg += (
+                f"├ ⚡ Предохранитель <code>{state.xui.breaker.state}</code>"
+                f" (ошибок подряд <code>{state.xui.breaker.consecutive_failures}</code>)\n"
+            )
+            status_msg += f"├ ⬆️ <code>{round(up)} Mbytes</code> ⬇️ <code>{round(down)} Mbytes</code>\n"
+            status_msg += f"└ 📈 <code>{round(up_rate)} KB/s</code> ⬆️ <code>{round(down_rate)} KB/s</code> ⬇️\n\n"
 
-        active_subs = len(await SubService.get_all_active())
+        # Счетчики из снимка stats, база опрашивается не чаще раза в STATS_TTL
+        dashboard = await stats.dashboard()
+        cache = dashboard.user_cache
 
         status_msg += "<b>👥 Пользовательская статистика</b>\n"
+        status_msg += f"├👤 Пользователей всего <code>{dashboard.users}</code>\n"
+        status_msg += f"├🔒 Активных подписок <code>{dashboard.active_subs}</code>\n"
         status_msg += (
-            f"├👤 Пользователей всего <code>{await UserService.count()}</code>\n"
+            f"└🗂 Кэш пользователей <code>{cache['size']}</code>"
+            f" (попаданий <code>{round(cache['hit_rate'] * 100)}%</code>)\n\n"
         )
-        status_msg += f"└🔒 Активных подписок <code>{active_subs}</code>\n"
+
+        queue = dashboard.outbox
+
+        status_msg += "<b>📬 Очередь изменений панелей</b>\n"
+        status_msg += f"├ ⏳ В очереди <code>{queue['depth']}</code>\n"
+        status_msg += f"├ ⚙️ В обработке <code>{queue['processing']}</code>\n"
+        status_msg += f"├ ❌ С ошибкой <code>{queue['failed']}</code>\n"
+        status_msg += f"└ 🕑 Задержка <code>{round(queue['lag'])} сек.</code>\n"
 
         await message.answer(status_msg)
 
+    @staticmethod
+    def render_drift(reports: list, applied: bool = False) -> str:
+        drift_msg = "<b>🔄 Синхронизация клиентов</b>\n\n"
+
+        for report in reports:
+            if "error" in report:
+                drift_msg += f"🔴 <b>{report['server']}</b>\n└ <code>{report['error']}</code>\n\n"
+                continue
+
+            drift = report["missing"] + report["outdated"] + report["stale"]
+
+            drift_msg += "🟢 " if not drift else "🟡 "
+            drift_msg += f"<b>{report['server']}</b> (клиентов <code>{report['clients']}</code>)\n"
+            drift_msg += f"├ ➕ Нет на панели <code>{report['missing']}</code>\n"
+            drift_msg += f"├ ✏️ Устарели <code>{report['outdated']}</code>\n"
+            drift_msg += f"{'├' if applied else '└'} ⛔ Без подписки <code>{report['stale']}</code>\n"
+
+            if applied:
+                drift_msg += (
+                    f"└ ✅ Применено <code>{report['added'] + report['updated'] + report['disabled']}</code>"
+                    f", ошибок <code>{report['failed']}</code>\n"
+                )
+
+            drift_msg += "\n"
+
+        return drift_msg
+
     @staticmethod
     async def is_user_subscribed(user_id: int) -> bool:
         try:
@@ -860,18 +921,10 @@ class Utils:
 class Admin:
     @staticmethod
     async def add_referal_days(user: User, days: int):
-        user.referral_days += days
+        # $inc и условное продление вместо перезаписи всего документа
+        await UserService.add_referral_days(user.id, days)
+        await SubService.extend(user.id, days, "Бонусная подписка")
 
-        sub = await user.get_active_sub()
-
-        if not sub:
-            custom_sub = {"name": "Бонусная подписка", "price": 0.00, "duration": days}
-            await Admin.add_subscription(user, custom_sub, notify=False)
-        else:
-            sub.datetime_end += timedelta(days=days)
-            await SubService.upsert(sub)
-
-        await UserService.upsert(user)
         await bot.send_message(
             user.id, f"🎉 Вам начислено <b>{days}</b> бонусных дней за реферала."
         )
@@ -929,9 +982,7 @@ class Admin:
             logger.error(f"user {user.id} not found.")
             return
 
-        user.balance += amount
-
-        await UserService.upsert(user)
+        await UserService.credit(user.id, amount)
 
         if notify:
             await bot.send_message(
@@ -960,7 +1011,7 @@ class Admin:
     @dp.message(Command(commands=["status"]))
     @admin_required
     async def command_status(message: types.Message, **kwargs):
-        await network.login_all()
+        # Серверы из текущего реестра: опрос панелей — дело monitor_servers и /login
         await Utils.render_status(message)
 
     @staticmethod
@@ -970,6 +1021,20 @@ class Admin:
         await network.login_all()
         await Utils.render_status(message)
 
+    @staticmethod
+    @dp.message(Command(commands=["drift"]))
+    @admin_required
+    async def command_drift(message: types.Message, **kwargs):
+        reports = await network.reconcile_all(dry_run=True)
+        await message.answer(Utils.render_drift(reports))
+
+    @staticmethod
+    @dp.message(Command(commands=["reconcile"]))
+    @admin_required
+    async def command_reconcile(message: types.Message, **kwargs):
+        reports = await network.reconcile_all()
+        await message.answer(Utils.render_drift(reports, applied=True))
+
     @staticmethod
     @dp.message(Command(commands=["add_balance"]))
     @admin_required
@@ -1060,19 +1125,12 @@ class Admin:
             await message.answer("Пользователь не найден.")
             return
 
-        if not any(sub["id"] == id for sub in SubService.POOL):
+        sub_data = pricing.CATALOG.get(id)
+
+        if not sub_data:
             await message.answer("Подписка не найдена по ID.")
             return
 
-        sub_data = {
-            "name": [sub["name_ru"] for sub in SubService.POOL if sub["id"] == id][0],
-            "id": id,
-            "price": [sub["price"] for sub in SubService.POOL if sub["id"] == id][0],
-            "duration": [sub["duration"] for sub in SubService.POOL if sub["id"] == id][
-                0
-            ],
-        }
-
         name = sub_data["name_ru"]
 
         await Admin.add_subscription(user, sub_data)
@@ -1110,10 +1168,12 @@ class Admin:
 async def monitor_servers():
     logger.info("started...")
 
-    xui_instances = await network.login_all()
+    servers = await registry.refresh()
 
-    for xui, is_logged_in, server_info in xui_instances:
-        if not is_logged_in:
+    for state in servers:
+        server_info = state.info
+
+        if not state.is_logged_in:
             logger.error(f'server {server_info["full_address"]} is not responding!')
 
             for admin in config.TELEGRAM_ADMINS:
@@ -1123,6 +1183,25 @@ async def monitor_servers():
                 )
 
 
+async def check_drift():
+    logger.info("started...")
+
+    reports = await network.reconcile_all()
+
+    # Администраторов уведомляем только если что-то пришлось исправлять
+    if not any(
+        "error" in report or report["missing"] + report["outdated"] + report["stale"]
+        for report in reports
+    ):
+        return
+
+    for admin in config.TELEGRAM_ADMINS:
+        await bot.send_message(
+            admin,
+            "<i>[ADMIN NOTIFY]</i> " + Utils.render_drift(reports, applied=True),
+        )
+
+
 async def notify_expiring_subs():
     logger.info(f"started...")
     kb = [
@@ -1131,11 +1210,8 @@ async def notify_expiring_subs():
         )
     ]
 
-    subscriptions = (
-        await SubService.get_expiring_subs()
-    )  # Получаем все подписки, у которых дата окончания подходит
-
-    for subscription in subscriptions:
+    # Подписки, у которых подходит дата окончания, читаются из курсора пачками
+    async for subscription in SubService.iter_expiring(lean=True):
         user = (
             await subscription.get_user()
         )  # Получаем пользователя для каждой подписки
@@ -1161,3 +1237,5 @@ async def notify_expiring_subs():
 async def start_cron_jobs():
     aiocron.crontab("*/5 * * * *", func=monitor_servers, start=True)
     aiocron.crontab("0 15 * * *", func=notify_expiring_subs, start=True)
+    aiocron.crontab(config.XUI_DRIFT_CRON, func=check_drift, start=True)
+    aiocron.crontab(config.TRAFFIC_SAMPLE_CRON, func=traffic.sample_all, start=True)
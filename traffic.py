@@ -0,0 +1,112 @@
+import asyncio
+
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+import config
+import registry
+
+from database import TrafficService
+from logger import logger
+
+
+class TrafficSample:
+    __slots__ = ("time", "inbounds")
+
+    def __init__(self, time: datetime, inbounds: Dict[int, Tuple[int, int]]):
+        self.time = time
+        self.inbounds = inbounds  # inbound_id -> (up, down) в байтах
+
+
+# Кольцевой буфер последних TRAFFIC_SAMPLES замеров на сервер
+SAMPLES: Dict[str, Deque[TrafficSample]] = {}
+
+
+async def sample_server(state) -> Optional[TrafficSample]:
+    try:
+        # Тот же get_inbounds, но ответ заодно обновляет снимки для ссылок
+        data = await state.xui.refresh_snapshots()
+    except Exception as e:
+        logger.error(f"{state.id}: failed to sample traffic: {e}")
+        return None
+
+    if not data.get("success"):
+        return None
+
+    sample = TrafficSample(
+        datetime.utcnow(),
+        {
+            inbound["id"]: (inbound.get("up", 0), inbound.get("down", 0))
+            for inbound in data.get("obj", [])
+        },
+    )
+
+    if state.id not in SAMPLES:
+        SAMPLES[state.id] = deque(maxlen=config.TRAFFIC_SAMPLES)
+    SAMPLES[state.id].append(sample)
+
+    return sample
+
+
+async def sample_all():
+    states = registry.REGISTRY.online
+    samples = await asyncio.gather(*[sample_server(state) for state in states])
+
+    if config.TRAFFIC_TIMESERIES:
+        await TrafficService.insert_many(
+            [
+                {
+                    "time": sample.time,
+                    "meta": {"server": state.id, "inbound": inbound_id},
+                    "up": up,
+                    "down": down,
+                }
+                for state, sample in zip(states, samples)
+                if sample is not None
+                for inbound_id, (up, down) in sample.inbounds.items()
+            ]
+        )
+
+
+def latest(server_id: str, inbound_id: int = 2) -> Tuple[int, int]:
+    samples = SAMPLES.get(server_id)
+
+    if not samples:
+        return 0, 0
+
+    return samples[-1].inbounds.get(inbound_id, (0, 0))
+
+
+def deltas(server_id: str, inbound_id: int = 2) -> List[Tuple[datetime, int, int]]:
+    """Прирост трафика (up, down) за каждый интервал между замерами."""
+    samples = list(SAMPLES.get(server_id, ()))
+    result = []
+
+    for prev, cur in zip(samples, samples[1:]):
+        prev_up, prev_down = prev.inbounds.get(inbound_id, (0, 0))
+        up, down = cur.inbounds.get(inbound_id, (0, 0))
+
+        # Счетчики панели сбрасываются при ресете трафика
+        result.append((cur.time, max(0, up - prev_up), max(0, down - prev_down)))
+
+    return result
+
+
+def rate(server_id: str, inbound_id: int = 2) -> Tuple[float, float]:
+    """Скорость (up, down) в байтах в секунду за последний интервал."""
+    samples = SAMPLES.get(server_id)
+
+    if not samples or len(samples) < 2:
+        return 0.0, 0.0
+
+    prev, cur = samples[-2], samples[-1]
+    interval = (cur.time - prev.time).total_seconds()
+
+    if not interval:
+        return 0.0, 0.0
+
+    prev_up, prev_down = prev.inbounds.get(inbound_id, (0, 0))
+    up, down = cur.inbounds.get(inbound_id, (0, 0))
+
+    return max(0, up - prev_up) / interval, max(0, down - prev_down) / interval